@@ -0,0 +1,207 @@
+"""
+    Micro-benchmark comparing the context cache's CacheDict (with and without
+    serialized entities) with the implementation it replaced, which kept the
+    value priorities in a list.
+
+    Run with: python benchmarks/cache_dict.py [entity count]
+"""
+import copy
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings  # noqa: E402
+
+settings.configure()
+
+from google.cloud.datastore.entity import Entity  # noqa: E402
+from google.cloud.datastore.key import Key  # noqa: E402
+
+from gcloudc.db.backends.datastore.context import CacheDict  # noqa: E402
+
+MAX_SIZE = 1024 * 1024 * 8
+
+
+class LegacyCacheDict(object):
+    """
+        The CacheDict implementation before the O(1) rewrite, kept for comparison
+    """
+
+    def __init__(self, max_size_in_bytes=None):
+        # This is a list of `id(value)` values in priority of most recently used
+        # to least recently used
+        self.value_priority = []
+
+        # This is a reverse lookup dict of id(value): {key1, key2, ...}
+        self.value_references = {}
+
+        # The actual entries, values are normally entities but it makes it easy to
+        # understand this class if you think of them as the references they are.
+        # Multiple keys can map to the same entity reference
+        self._entries = {}
+
+        # THe total size of all values in bytes
+        self.total_value_size = 0
+
+        # The max size in bytes that the total values can become
+        self.max_size_in_bytes = max_size_in_bytes
+
+    def _set_value(self, k, v):
+        """
+            Sets a value in the _entries dictionary but manages the associated
+            data in value_priority and value_references including when a key already
+            exists with a different value
+        """
+
+        if k in self._entries:
+            # We already have a value, we need to clean up
+            old_value = self._entries[k]
+
+            # Same object, do nothing
+            if id(old_value) == id(v):
+                return
+
+            old_key = id(old_value)
+
+            self.value_references[old_key].remove(k)
+            del self._entries[k]
+
+            if not self.value_references[old_key]:
+                self._purge_value(old_value)
+
+        priority_key = id(v)
+
+        existing_value = priority_key in self.value_priority
+
+        self.value_references.setdefault(priority_key, set()).add(k)
+        if priority_key not in self.value_priority:
+            self.value_priority.insert(len(self.value_priority) // 2, priority_key)
+
+        self._entries[k] = v
+
+        # If we added a new value to the dict, we increase the used size
+        if not existing_value:
+            self.total_value_size += sys.getsizeof(v)
+
+    def _check_size_and_limit(self):
+        """
+            If the dict size is larger than the max specified bytes,
+            we remove entities by deleting all their associated keys
+        """
+        while self.total_value_size > self.max_size_in_bytes:
+            next_priority_key = self.value_priority[-1]
+
+            # We intentionally copy the result with list() as this will be manipulated
+            # in del self[reference]
+            for reference in list(self.value_references[next_priority_key]):
+                del self[reference]
+
+    def _set(self, k, v):
+        self._set_value(k, v)
+        self._check_size_and_limit()
+
+    def set_multi(self, keys, value):
+        """
+            This is the only public setting API because we don't want to
+            duplicate values across keys unnecessarily but we *do* want to copy
+            the value passed in by the user to protect against accidental manipulation
+            of the cached value
+        """
+
+        value = copy.deepcopy(value)  # Copy once
+        for k in set(keys):
+            # Set the same value for multiple keys
+            self._set(k, value)
+
+    def __getitem__(self, k):
+        v = self._entries[k]  # Find the entry
+
+        # Move the value up the value priority (remove the id() and add it back at the front)
+        priority_key = id(v)
+        self.value_priority.remove(priority_key)
+        self.value_priority.insert(0, priority_key)
+        return copy.deepcopy(v)
+
+    def _purge_value(self, v):
+        priority_key = id(v)
+        del self.value_references[priority_key]
+        self.value_priority.remove(priority_key)
+        self.total_value_size -= sys.getsizeof(v)
+
+    def __delitem__(self, k):
+        assert set([id(x) for x in self._entries.values()]) == set(self.value_priority)
+        v = self._entries[k]
+        priority_key = id(v)
+
+        self.value_references[priority_key].remove(k)
+        # Only remove from the priority (and adjust the size)
+        # if the value no longer exists in the dictionary
+        if not self.value_references[priority_key]:
+            self._purge_value(v)
+
+        del self._entries[k]
+
+        assert set([id(x) for x in self._entries.values()]) == set(self.value_priority)
+
+    def __contains__(self, k):
+        return k in self.keys()
+
+    def keys(self):
+        return self._entries.keys()
+
+
+class SerializingCacheDict(CacheDict):
+    def __init__(self, max_size_in_bytes=None):
+        super(SerializingCacheDict, self).__init__(max_size_in_bytes, serialize_entities=True)
+
+
+def make_entities(count):
+    entities = []
+    for i in range(1, count + 1):
+        entity = Entity(Key("Benchmark", i, project="benchmark"))
+        entity.update({"name": "entity-%s" % i, "value": i})
+        entities.append(entity)
+    return entities
+
+
+def fill(cache_dict, entities):
+    for entity in entities:
+        # Entities are cached under their key and a unique identifier, like the context cache does
+        cache_dict.set_multi([entity.key, "Benchmark|name:%s" % entity["name"]], entity)
+
+
+def run(cache_class, entities):
+    cache_dict = cache_class(max_size_in_bytes=MAX_SIZE)
+    fill(cache_dict, entities)
+
+    for entity in entities:
+        cache_dict[entity.key]
+
+    for entity in entities:
+        assert entity.key in cache_dict
+
+    for entity in entities:
+        del cache_dict[entity.key]
+
+
+def run_evictions(cache_class, entities):
+    # Budget for roughly a tenth of the entities, so most sets evict
+    cache_dict = cache_class(max_size_in_bytes=sys.getsizeof(entities[0]) * (len(entities) // 10))
+    fill(cache_dict, entities)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    entities = make_entities(count)
+    number = 3
+
+    for name, func in (("get/set/contains/delete", run), ("evictions", run_evictions)):
+        for cache_class in (LegacyCacheDict, CacheDict, SerializingCacheDict):
+            seconds = min(timeit.repeat(lambda: func(cache_class, entities), number=1, repeat=number))
+            print("%-25s %-20s %d entities: %.4fs" % (name, cache_class.__name__, count, seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -53,16 +53,7 @@ class ContextDecorator(object):
         # Called if this has been used as a decorator not as a context manager
 
         def decorated(*_args, **_kwargs):
-            decorator_args = self.decorator_args.copy()
-            exception = False
-            self.__class__._do_enter(self._push_state(), decorator_args)
-            try:
-                return self.func(*_args, **_kwargs)
-            except Exception:
-                exception = True
-                raise
-            finally:
-                self.__class__._do_exit(self._pop_state(), decorator_args, exception)
+            return self._call_decorated(self.decorator_args.copy(), _args, _kwargs)
 
         if not self.func:
             # We were instantiated with args
@@ -71,6 +62,18 @@ class ContextDecorator(object):
         else:
             return decorated(*args, **kwargs)
 
+    def _call_decorated(self, decorator_args, args, kwargs):
+        "Calls the decorated function once, subclasses can override this to call it again"
+        exception = False
+        self.__class__._do_enter(self._push_state(), decorator_args)
+        try:
+            return self.func(*args, **kwargs)
+        except Exception:
+            exception = True
+            raise
+        finally:
+            self.__class__._do_exit(self._pop_state(), decorator_args, exception)
+
     def _push_state(self):
         "We need a stack for state in case a decorator is called recursively"
         # self.state is a threading.local() object, so if the current thread is not the one in
@@ -31,6 +31,7 @@ from google.cloud import (
 )
 
 from . import dbapi as Database
+from . import transaction
 from .commands import (
     DeleteCommand,
     FlushCommand,
@@ -140,6 +141,9 @@ class Cursor(object):
             self.returned_ids.append(result.key.id_or_name)
             return row
         except StopIteration:
+            # Results are streamed, so we only know how many rows there were
+            # once they've all been read
+            self.rowcount = self.last_select_command.results_returned or -1
             return None
 
     def fetchmany(self, size, delete_flag=False):
@@ -188,7 +192,7 @@ class DatabaseOperations(BaseDatabaseOperations):
         # This value is used in cascade deletions, and also on bulk insertions
         # This is the limit of the number of entities that can be manipulated in
         # a single transaction
-        return 500
+        return transaction.get_entity_limit(self.connection.alias)
 
     def quote_name(self, name):
         return name
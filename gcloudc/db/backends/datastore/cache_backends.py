@@ -0,0 +1,86 @@
+import threading
+import time
+
+from django.core.cache import caches
+
+
+class CacheBackend(object):
+    """
+        The interface of an external cache used for entities, shared between
+        processes (and instances). Keys are strings which are safe to use with
+        memcached, values are bytes or strings.
+    """
+
+    def get_multi(self, keys):
+        """
+            Returns a dict of key: value for the keys which were found
+        """
+        raise NotImplementedError()
+
+    def set_multi(self, mapping, timeout):
+        raise NotImplementedError()
+
+    def delete_multi(self, keys):
+        raise NotImplementedError()
+
+
+class DjangoCacheBackend(CacheBackend):
+    """
+        Uses one of the caches in Django's CACHES setting, so anything Django
+        can talk to (memcached, or Redis with django-redis) can be used.
+    """
+
+    def __init__(self, alias="default"):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        # Django's cache handler is thread-local, so look it up each time
+        return caches[self.alias]
+
+    def get_multi(self, keys):
+        return self.cache.get_many(keys)
+
+    def set_multi(self, mapping, timeout):
+        self.cache.set_many(mapping, timeout=timeout)
+
+    def delete_multi(self, keys):
+        self.cache.delete_many(keys)
+
+
+class LocalCacheBackend(CacheBackend):
+    """
+        An in-process stand-in for an external cache, mainly for tests
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def get_multi(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            found = {}
+            for key in keys:
+                if key in self._values:
+                    value, expires = self._values[key]
+                    if expires > now:
+                        found[key] = value
+                    else:
+                        del self._values[key]
+            return found
+
+    def set_multi(self, mapping, timeout):
+        expires = time.monotonic() + timeout
+        with self._lock:
+            for key, value in mapping.items():
+                self._values[key] = (value, expires)
+
+    def delete_multi(self, keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
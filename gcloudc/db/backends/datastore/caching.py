@@ -1,11 +1,15 @@
 import logging
 import threading
+from hashlib import md5
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from google.cloud.datastore import helpers
+from google.cloud.datastore_v1.proto import entity_pb2
 
 from . import utils
-from .context import ContextCache, key_or_entity_compare
+from .context import ContextCache, SerializedEntity, SharedCache
 from .unique_utils import _format_value_for_identifier, unique_identifiers_from_entity
 
 _local = threading.local()
@@ -30,6 +34,154 @@ DEFAULT_MAX_ENTITY_COUNT = 8
 MAX_CACHE_COUNT = getattr(settings, "GCLOUDC_CACHE_MAX_ENTITY_COUNT", DEFAULT_MAX_ENTITY_COUNT)
 
 
+# The process-wide cache is only used for the models listed (by label, e.g. "app.Model")
+# in the GCLOUDC_SHARED_CACHE_MODELS setting. Writes only invalidate the cache of the
+# process which made them, the other processes can keep serving the entity they had
+# cached for up to GCLOUDC_SHARED_CACHE_TIMEOUT seconds, so keep it short for models
+# which are written from several instances.
+DEFAULT_SHARED_CACHE_MAX_SIZE = 1024 * 1024 * 32
+DEFAULT_SHARED_CACHE_TIMEOUT = 60
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache():
+    global _shared_cache
+
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = SharedCache(
+                getattr(settings, "GCLOUDC_SHARED_CACHE_MAX_SIZE", DEFAULT_SHARED_CACHE_MAX_SIZE),
+                getattr(settings, "GCLOUDC_SHARED_CACHE_TIMEOUT", DEFAULT_SHARED_CACHE_TIMEOUT),
+            )
+        return _shared_cache
+
+
+def _shared_cache_enabled(model=None, using=None):
+    """
+        The shared cache is bypassed inside transactions, as they don't see the
+        current state of the datastore (and the cache might not see theirs). That's
+        a transaction on `using`, or if that isn't given on the connection the
+        model is read from.
+    """
+    from django.db import router
+    from gcloudc.db.transaction import in_atomic_block
+
+    shared_models = getattr(settings, "GCLOUDC_SHARED_CACHE_MODELS", ())
+    if not shared_models or not get_context().context_enabled:
+        return False
+
+    if model is not None and model._meta.label not in shared_models:
+        return False
+
+    if using is None:
+        using = router.db_for_read(model) if model is not None else "default"
+
+    return not in_atomic_block(using=using)
+
+
+def remove_entities_from_shared_cache(keys):
+    """
+        Given an iterable of datastore.Keys (with the namespace applied), remove the
+        corresponding entities from the process-wide and external caches. This is
+        called for every write, once it has been committed
+    """
+    if not CACHE_ENABLED or not getattr(settings, "GCLOUDC_SHARED_CACHE_MODELS", ()):
+        return
+
+    keys = list(keys)
+    get_shared_cache().remove_keys(keys)
+
+    backend = get_cache_backend()
+    if backend and keys:
+        backend.delete_multi([_backend_key_for_datastore_key(x) for x in keys])
+
+
+def shared_cache_generation(model, using=None):
+    """
+        Returns the process-wide cache's invalidation generation. This should be taken
+        before reading entities of the model from the datastore, and passed to
+        add_entities_to_cache so that any which were written while they were being
+        read aren't cached. Returns None if the entities can't be shared.
+    """
+    if not CACHE_ENABLED or not _shared_cache_enabled(model, using):
+        return None
+
+    return get_shared_cache().generation()
+
+
+def clear_shared_cache():
+    if _shared_cache is not None:
+        _shared_cache.clear()
+
+
+# The external cache is configured with GCLOUDC_CACHE_BACKEND, the dotted path of a
+# cache_backends.CacheBackend, which is created with GCLOUDC_CACHE_BACKEND_OPTIONS.
+#
+# Entities are kept there for GCLOUDC_CACHE_BACKEND_TIMEOUT seconds, which should be
+# kept short. A read which raced with a write in the same process is caught, but one
+# which raced with a write in another process can put the entity it read back after
+# that write deleted it, and nothing removes it until it expires. Other processes'
+# process-wide caches aren't invalidated either (see GCLOUDC_SHARED_CACHE_TIMEOUT).
+DEFAULT_CACHE_BACKEND_TIMEOUT = 10
+
+_cache_backend = (None, None)
+
+
+def get_cache_backend():
+    global _cache_backend
+
+    backend_path = getattr(settings, "GCLOUDC_CACHE_BACKEND", None)
+    if not backend_path:
+        return None
+
+    with _shared_cache_lock:
+        path, backend = _cache_backend
+        if path != backend_path:
+            options = getattr(settings, "GCLOUDC_CACHE_BACKEND_OPTIONS", {})
+            backend = import_string(backend_path)(**options)
+            _cache_backend = (backend_path, backend)
+        return backend
+
+
+def _backend_key(identifier):
+    # Identifiers can contain anything, but memcached keys can't
+    return "gcloudc:{}".format(md5(identifier.encode("utf-8")).hexdigest())
+
+
+def _backend_key_for_datastore_key(key):
+    identifier = "|".join(
+        [key.project, key.namespace or ""] + [str(x) for x in key.flat_path]
+    )
+    return _backend_key(identifier)
+
+
+def _backend_enabled(model=None, using=None):
+    return (
+        _shared_cache_enabled(model, using) and get_context().memcache_enabled and get_cache_backend() is not None
+    )
+
+
+def _values_for_backend(identifiers, entity):
+    """
+        The entity itself is stored under its key, and each of its identifiers
+        points at that. That way invalidating the key is enough to invalidate
+        every identifier, without having to know what they were.
+    """
+    entity_key = _backend_key_for_datastore_key(entity.key)
+
+    values = {entity_key: SerializedEntity(entity).data}
+    for identifier in identifiers:
+        values[_backend_key(identifier)] = entity_key
+
+    return values
+
+
+def _entity_from_backend(data):
+    return helpers.entity_from_protobuf(entity_pb2.Entity.FromString(data))
+
+
 class CachingSituation:
     DATASTORE_GET = 0
     DATASTORE_PUT = 1
@@ -90,7 +242,12 @@ def _get_cache_key_and_model_from_datastore_key(key):
     return (cache_key, model)
 
 
-def add_entities_to_cache(model, entities, situation, namespace):
+def add_entities_to_cache(model, entities, situation, namespace, read_generation=None):
+    """
+        Caches the entities in the context cache and, if `read_generation` is passed
+        (see shared_cache_generation), in the process-wide and external caches.
+        Written entities aren't added to those, the writes invalidate them instead.
+    """
     from gcloudc.db.transaction import in_atomic_block
 
     if not CACHE_ENABLED:
@@ -110,8 +267,34 @@ def add_entities_to_cache(model, entities, situation, namespace):
 
     identifiers = [unique_identifiers_from_entity(model, entity) for entity in entities]
 
+    # The generation is only given if the shared tiers were enabled when the entities were read
+    shared_cache = None if read_generation is None else get_shared_cache()
+    backend = get_cache_backend() if shared_cache and context.memcache_enabled else None
+    backend_values = {}
+    backend_entity_keys = []
+
     for ent_identifiers, entity in zip(identifiers, entities):
-        get_context().stack.top.cache_entity(_apply_namespace(ent_identifiers, namespace), entity, situation)
+        ent_identifiers = _apply_namespace(ent_identifiers, namespace)
+        get_context().stack.top.cache_entity(ent_identifiers, entity, situation)
+
+        if shared_cache:
+            shared_cache.set_multi(ent_identifiers, entity, read_generation)
+
+        if backend and not shared_cache.invalidated_since(entity.key, read_generation):
+            backend_values.update(_values_for_backend(ent_identifiers, entity))
+            backend_entity_keys.append(entity.key)
+
+    if backend_values:
+        backend.set_multi(
+            backend_values, getattr(settings, "GCLOUDC_CACHE_BACKEND_TIMEOUT", DEFAULT_CACHE_BACKEND_TIMEOUT)
+        )
+
+        # A write in this process could have invalidated one of the entities between
+        # checking it above and the entity being set, in which case the write's delete
+        # might have reached the backend first. So we check again now it's been set.
+        stale = [key for key in backend_entity_keys if shared_cache.invalidated_since(key, read_generation)]
+        if stale:
+            backend.delete_multi([_backend_key_for_datastore_key(x) for x in stale])
 
 
 def remove_entities_from_cache_by_key(keys, namespace):
@@ -125,29 +308,57 @@ def remove_entities_from_cache_by_key(keys, namespace):
     context = get_context()
 
     for key in keys:
-        identifiers = context.stack.top.cache.get_reversed(key, compare_func=key_or_entity_compare)
-
-        for identifier in identifiers:
-            if identifier in context.stack.top.cache:
-                del context.stack.top.cache[identifier]
+        for identifier in context.stack.top.cache.keys_for_entity_key(key):
+            del context.stack.top.cache[identifier]
 
 
-def get_from_cache_by_key(key):
+def get_from_cache_by_key(key, using=None):
     """
         Given a datastore.Key (which should already have the namespace applied to it), return an
         entity from the context cache
     """
+    return get_from_cache_by_keys([key], using=using).get(key)
+
+
+def get_from_cache_by_keys(keys, using=None):
+    """
+        Given an iterable of datastore.Keys (with the namespace applied), return a dict
+        of key: entity for those which could be found in the caches. Each tier is only
+        asked for the keys the ones before it didn't have, and the external cache is
+        asked for all of those at once. The shared tiers are skipped in transactions
+        on `using` (the default connection if it isn't given).
+    """
 
     if not CACHE_ENABLED:
-        return None
+        return {}
+
+    found = {}
+    missing = []
+
+    shared_cache = get_shared_cache() if _shared_cache_enabled(using=using) else None
 
     context = get_context()
-    ret = None
-    if context.context_enabled:
-        # It's safe to hit the context cache, because a new one was pushed on the stack at the start of the transaction
-        ret = context.stack.top.get_entity_by_key(key)
+    for key in keys:
+        ret = None
+        if context.context_enabled:
+            # It's safe to hit the context cache, because a new one was pushed on the
+            # stack at the start of the transaction
+            ret = context.stack.top.get_entity_by_key(key)
 
-    return ret
+        if ret is None and shared_cache:
+            ret = shared_cache.get_by_key(key)
+
+        if ret is None:
+            missing.append(key)
+        else:
+            found[key] = ret
+
+    if missing and _backend_enabled(using=using):
+        backend_keys = {_backend_key_for_datastore_key(key): key for key in missing}
+        for backend_key, data in get_cache_backend().get_multi(list(backend_keys)).items():
+            found[backend_keys[backend_key]] = _entity_from_backend(data)
+
+    return found
 
 
 def get_from_cache(unique_identifier, namespace):
@@ -165,9 +376,38 @@ def get_from_cache(unique_identifier, namespace):
         # It's safe to hit the context cache, because a new one was pushed on the stack at the start of the transaction
         ret = context.stack.top.get_entity(cache_key)
 
+    if ret is None and _shared_cache_enabled():
+        ret = get_shared_cache().get(cache_key)
+
+    if ret is None and _backend_enabled():
+        ret = _get_from_backend(cache_key, namespace)
+
     return ret
 
 
+def _get_from_backend(cache_key, namespace):
+    backend = get_cache_backend()
+
+    identifier_key = _backend_key(cache_key)
+    entity_key = backend.get_multi([identifier_key]).get(identifier_key)
+    if entity_key is None:
+        return None
+
+    data = backend.get_multi([entity_key]).get(entity_key)
+    if data is None:
+        return None
+
+    entity = _entity_from_backend(data)
+
+    # The entity might have changed since the identifier pointed at it, so we
+    # make sure it still has that identifier
+    model = utils.get_model_from_db_table(entity.key.kind)
+    if model is None or cache_key not in _apply_namespace(unique_identifiers_from_entity(model, entity), namespace):
+        return None
+
+    return entity
+
+
 def reset_context(keep_disabled_flags=False, *args, **kwargs):
     """
         Called at the beginning and end of each request, resets the thread local
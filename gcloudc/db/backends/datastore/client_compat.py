@@ -0,0 +1,83 @@
+"""
+    The few things we need which google-cloud-datastore doesn't expose publicly.
+
+    These go through the client's private _datastore_api (and the query protobuf
+    builder) and are written against google-cloud-datastore 1.9.0, the version
+    pinned in setup.py. Upgrading the client means checking this module, and
+    nothing outside of it should touch the client's internals.
+"""
+from google.cloud.datastore import helpers
+from google.cloud.datastore.query import _pb_from_query
+from google.cloud.datastore_v1.proto import datastore_pb2, entity_pb2
+
+
+def reserve_ids(client, keys):
+    """
+        Reserves the ids of all the given (complete) keys with a single RPC,
+        Client.reserve_ids only takes a single key
+    """
+    client._datastore_api.reserve_ids(keys[0].project, [x.to_protobuf() for x in keys])
+
+
+def lookup_with_versions(client, keys):
+    """
+        Like Client.get_multi, but returns (entity, version) for each entity
+        which exists. The version changes every time the entity is written.
+    """
+    results = []
+    key_pbs = [x.to_protobuf() for x in keys]
+    while key_pbs:
+        response = client._datastore_api.lookup(client.project, key_pbs, read_options=datastore_pb2.ReadOptions())
+        results.extend((helpers.entity_from_protobuf(x.entity), x.version) for x in response.found)
+
+        # The datastore can defer some of the keys to another lookup
+        key_pbs = list(response.deferred)
+
+    return results
+
+
+def put_if_unchanged(client, entities_and_versions):
+    """
+        Upserts each entity with a non-transactional commit, but only if it
+        hasn't been written since it was read at the given version. Returns the
+        entities which were written, and those which had changed (and weren't).
+    """
+    entities = [entity for entity, _ in entities_and_versions]
+    mutations = [
+        datastore_pb2.Mutation(upsert=helpers.entity_to_protobuf(entity), base_version=version)
+        for entity, version in entities_and_versions
+    ]
+
+    response = client._datastore_api.commit(
+        client.project, datastore_pb2.CommitRequest.NON_TRANSACTIONAL, mutations
+    )
+
+    written = []
+    changed = []
+    for entity, mutation_result in zip(entities, response.mutation_results):
+        if mutation_result.conflict_detected:
+            changed.append(entity)
+        else:
+            written.append(entity)
+
+    return written, changed
+
+
+def query_to_protobuf(query):
+    return _pb_from_query(query)
+
+
+def run_query_protobuf(query, query_pb):
+    """
+        Runs a query protobuf (from query_to_protobuf) in the query's namespace,
+        and the client's current transaction if there is one. Returns the
+        result batch.
+    """
+    client = query._client
+    current_transaction = client.current_transaction
+    read_options = helpers.get_read_options(
+        False, current_transaction.id if current_transaction else None
+    )
+    partition_id = entity_pb2.PartitionId(project_id=query.project, namespace_id=query.namespace)
+
+    return client._datastore_api.run_query(query.project, partition_id, read_options, query=query_pb).batch
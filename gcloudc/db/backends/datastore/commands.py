@@ -1,17 +1,25 @@
-import copy
 import decimal
 import logging
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from datetime import datetime
+from itertools import chain, islice
 
 import django
-from django.db import DatabaseError, IntegrityError
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connections
 from django.utils import six
 from django.utils.encoding import force_str, python_2_unicode_compatible
 from google.cloud.datastore.entity import Entity
 from google.cloud.datastore.key import Key
 from google.cloud.datastore.query import Query
 
-from . import POLYMODEL_CLASS_ATTRIBUTE, meta_queries, transaction, utils
+from . import POLYMODEL_CLASS_ATTRIBUTE, client_compat, meta_queries, transaction, utils
 from .caching import remove_entities_from_cache_by_key
 from .constraints import (
     CONSTRAINT_VIOLATION_MSG,
@@ -20,9 +28,9 @@ from .constraints import (
 )
 
 from .dbapi import NotSupportedError
-from .dnf import normalize_query
+from .executor import get_executor
 from .formatting import generate_sql_representation
-from .query import transform_query
+from .query_plans import get_normalized_query
 from .query_utils import get_filter, has_filter
 from .unique_utils import query_is_unique, _unique_combinations
 from .utils import (
@@ -295,9 +303,8 @@ class SelectCommand(object):
         self.connection = connection.alias
         self.namespace = connection.ops.connection.settings_dict.get("NAMESPACE")
 
-        self.query = transform_query(connection, query)
-        self.query.prepare()
-        self.query = normalize_query(self.query)
+        # Queries of the same shape share the work of preparing and normalizing
+        self.query = get_normalized_query(connection, query)
 
         self.original_query = query
 
@@ -337,6 +344,25 @@ class SelectCommand(object):
 
         return [x for x in columns if x not in (opts.pk.column, copts.pk.column)]
 
+    def _prep_filter_value(self, filter_node, value):
+        # This is a special case. Annoyingly Django's decimal field doesn't
+        # ever call ops.get_prep_save or lookup or whatever when you are filtering
+        # on a query. It *does* do it on a save, so we basically need to do a
+        # conversion here, when really it should be handled elsewhere
+        if isinstance(value, decimal.Decimal):
+            field = get_field_from_column(self.query.model, filter_node.column)
+            value = self.connection.ops.adapt_decimalfield_value(value, field.max_digits, field.decimal_places)
+        elif isinstance(value, six.string_types):
+            value = coerce_unicode(value)
+        elif isinstance(value, Key):
+            # Make sure we apply the current namespace to any lookups
+            # by key. Fixme: if we ever add key properties this will break if
+            # someone is trying to filter on a key which has a different namespace
+            # to the active one.
+            value = transaction._rpc(self.connection).key(value.kind, value.id_or_name)
+
+        return value
+
     def _build_query(self):
         self._sanity_check()
 
@@ -385,26 +411,17 @@ class SelectCommand(object):
             # This deals with the oddity that the root of the tree may well be a leaf
             filters = [and_branch] if and_branch.is_leaf else and_branch.children
 
+            keys = None
             for filter_node in filters:
                 lookup = (filter_node.column, filter_node.operator)
 
-                value = filter_node.value
-
-                # This is a special case. Annoyingly Django's decimal field doesn't
-                # ever call ops.get_prep_save or lookup or whatever when you are filtering
-                # on a query. It *does* do it on a save, so we basically need to do a
-                # conversion here, when really it should be handled elsewhere
-                if isinstance(value, decimal.Decimal):
-                    field = get_field_from_column(self.query.model, filter_node.column)
-                    value = self.connection.ops.adapt_decimalfield_value(value, field.max_digits, field.decimal_places)
-                elif isinstance(value, six.string_types):
-                    value = coerce_unicode(value)
-                elif isinstance(value, Key):
-                    # Make sure we apply the current namespace to any lookups
-                    # by key. Fixme: if we ever add key properties this will break if
-                    # someone is trying to filter on a key which has a different namespace
-                    # to the active one.
-                    value = rpc.key(value.kind, value.id_or_name)
+                if lookup == ("__key__", "IN"):
+                    # Only produced by dnf.normalize_key_lookup, the keys are fetched with
+                    # a Get and the rest of the filters are applied to the entities in memory
+                    keys = [self._prep_filter_value(filter_node, x) for x in filter_node.value]
+                    continue
+
+                value = self._prep_filter_value(filter_node, filter_node.value)
 
                 # If there is already a value for this lookup, we need to make the
                 # value a list and append the new entry
@@ -429,6 +446,12 @@ class SelectCommand(object):
             if ordering:
                 query.order = ordering
 
+            if keys is not None:
+                # Key lookups are always normalized into a single branch
+                return meta_queries.QueryByKeys.from_keys(
+                    self.connection, self.query.model, keys, query, ordering, self.namespace
+                )
+
             queries.append(query)
 
         if can_perform_datastore_get(self.query):
@@ -443,7 +466,7 @@ class SelectCommand(object):
 
             return queries[0]
         else:
-            return meta_queries.AsyncMultiQuery(queries, ordering)
+            return meta_queries.AsyncMultiQuery(queries, ordering, using=self.connection)
 
     def _fetch_results(self, query):
         # If we're manually excluding PKs, and we've specified a limit to the results
@@ -480,24 +503,36 @@ class SelectCommand(object):
                     # If this is a QueryByKeys, just do the datastore Get and count the results
                     resultset = (x.key for x in query.fetch(limit=limit, offset=offset) if x)
                 else:
-                    count_query = Query(query._Query__kind, keys_only=True, namespace=self.namespace)
-                    count_query.update(query)
-                    resultset = count_query.Run(limit=limit, offset=offset)
-                self.results = [len([y for y in resultset if y not in excluded_pks])]
-                self.results_returned = 1
+                    query.keys_only()
+                    resultset = (
+                        x if isinstance(x, Key) else x.key for x in query.fetch(limit=limit, offset=offset)
+                    )
+
+                count = len([y for y in resultset if y not in excluded_pks])
+                if limit:
+                    count = min(count, limit - excluded_pk_count)
             else:
-                query.keys_only()
+                # Count on the server where possible, rather than pulling every key over the wire
+                count = utils.count_query(query, limit=limit, offset=offset)
 
-                self.results = [len(list(query.fetch(limit=limit, offset=offset)))]
-                self.results_returned = 1
+            self.results = [count]
+            self.results_returned = 1
             return
         elif self.query.kind == "AVERAGE":
             raise ValueError("AVERAGE not yet supported")
 
         # Ensure that the results returned is reset
         self.results_returned = 0
-        self.results = []
 
+        # Results are streamed rather than gathered up front, the datastore iterator
+        # fetches a page at a time as the cursor consumes the results, and each
+        # entity is only transformed when it's reached. That way Django's chunked
+        # reads (e.g. QuerySet.iterator()) don't hold the whole resultset in memory
+        self.results = self._iter_results(
+            query.fetch(limit=limit, offset=offset), excluded_pks, limit and (limit - excluded_pk_count)
+        )
+
+    def _iter_results(self, entities, excluded_pks, limit):
         seen = set()
 
         def dedupe(result):
@@ -516,7 +551,7 @@ class SelectCommand(object):
             seen.add(key)
             return result
 
-        for entity in query.fetch(limit=limit, offset=offset):
+        for entity in entities:
             # If this is a keys only query, we need to generate a fake entity
             # for each key in the result set
             if isinstance(entity, Key):
@@ -532,16 +567,22 @@ class SelectCommand(object):
                 entity = dedupe(entity)
 
             if entity:
-                self.results.append(entity)
                 self.results_returned += 1
+                yield entity
 
-            if limit and self.results_returned >= (limit - excluded_pk_count):
+            if limit and self.results_returned >= limit:
                 break
 
     def execute(self):
+        """
+            Runs the query. Apart from counts, the results are read lazily
+            from self.results, so the number of results returned is only
+            known once they have all been consumed.
+        """
         self.gae_query = self._build_query()
         self._fetch_results(self.gae_query)
-        self.results = iter(self.results)
+        if self.query.kind == "COUNT":
+            self.results = iter(self.results)
         return self.results_returned
 
     def __repr__(self):
@@ -583,34 +624,86 @@ class FlushCommand(object):
             results = [x.key for x in query.fetch()]
 
 
-def reserve_id(connection, kind, id_or_name, namespace):
-    if not isinstance(id_or_name, int):
-        # Nothing to do if the ID is a string, no-need to reserve that
+def reserve_ids(connection, keys):
+    """
+        Prevents the integer ids of the given (complete) keys from being
+        auto-allocated, reserving all of them with a single RPC
+    """
+    # Nothing to do if the ID is a string, no-need to reserve that
+    keys = [x for x in keys if isinstance(x.id_or_name, int)]
+    if not keys:
         return
 
-    gclient = connection.connection.gclient
-    gclient.reserve_ids(gclient.key(kind, id_or_name, namespace=namespace), 1)
+    client_compat.reserve_ids(connection.connection.gclient, keys)
+
 
+def _unique_check_query(model, rpc, primary, combination):
+    """
+        Returns a keys-only query which finds any stored entities sharing the values
+        of `combination` with `primary`, or None if there is nothing to query on
+    """
+    query = rpc.query(kind=primary.kind)
+    query.keys_only()
+
+    for field in combination:
+        col_name = model._meta.get_field(field).column
+        value = primary.get(col_name)
+        if isinstance(value, list):
+            for item in value:
+                query.add_filter(col_name, '=', item)
+        elif value is not None:
+            query.add_filter(col_name, '=', value)
 
-def perform_unique_checks(model, rpc, primary, test_fn):
+    # only perform the query if there are filters on it
+    return query if len(query.filters) else None
+
+
+def perform_unique_checks(model, rpc, entities, using="default"):
+    """
+        Checks that none of the entities clash with a stored entity on any of
+        the unique constraints of the model, raising an IntegrityError if they do.
+
+        Lookups are gathered across the whole batch first, so that a lookup shared
+        by several entities is only run once. Outside of transactions the queries
+        are then run concurrently on the shared executor.
+    """
     combinations = _unique_combinations(model, ignore_pk=True)
-    for combination in combinations:
-        query = rpc.query(kind=primary.kind)
 
-        for field in combination:
-            col_name = model._meta.get_field(field).column
-            value = primary.get(col_name)
-            if isinstance(value, list):
-                for item in value:
-                    query.add_filter(col_name, '=', item)
-            elif value is not None:
-                query.add_filter(col_name, '=', value)
+    queries = {}
+    checks = []
+    for entity in entities:
+        for combination in combinations:
+            query = _unique_check_query(model, rpc, entity, combination)
+            if query is None:
+                continue
+
+            try:
+                lookup = tuple(query.filters)
+                hash(lookup)
+            except TypeError:
+                # Unhashable values can't be shared, just query for them separately
+                lookup = id(query)
+
+            queries.setdefault(lookup, query)
+            checks.append((entity, combination, lookup))
+
+    def run(query):
+        # We fetch 2 results, as one of them might be the entity we're checking
+        return [x.key for x in query.fetch(limit=2)]
+
+    # Transactions are tied to the thread, the queries must run in this one to be
+    # part of the transaction, otherwise a conflicting write could slip in between
+    # the check and the commit
+    if len(queries) == 1 or transaction.in_atomic_block(using=using):
+        stored = {lookup: run(query) for lookup, query in queries.items()}
+    else:
+        executor = get_executor()
+        futures = {lookup: executor.submit(run, query) for lookup, query in queries.items()}
+        stored = {lookup: future.result() for lookup, future in futures.items()}
 
-        # only perform the query if there are filters on it
-        if len(query.filters):
-            res = list(query.fetch(1))
-            if test_fn(res):
-                raise IntegrityError(CONSTRAINT_VIOLATION_MSG.format(model._meta.db_table, ", ".join(combination)))
+    for entity, combination, lookup in checks:
+        if any(key != entity.key for key in stored[lookup]):
+            raise IntegrityError(CONSTRAINT_VIOLATION_MSG.format(model._meta.db_table, ", ".join(combination)))
 
 
 class BulkInsertError(IntegrityError, NotSupportedError):
@@ -621,6 +714,11 @@ class BulkDeleteError(IntegrityError, NotSupportedError):
     pass
 
 
+# The number of delete batches which are committed at once when a delete
+# spans more entities than fit in a single transaction
+DEFAULT_BULK_DELETE_CONCURRENCY = 1
+
+
 @python_2_unicode_compatible
 class InsertCommand(object):
     def __init__(self, connection, model, objs, fields, raw):
@@ -675,24 +773,40 @@ class InsertCommand(object):
         """
         check_existence = self.has_pk and not has_concrete_parents(self.model)
 
+        def allocate_keys(rpc, entities):
+            """
+                Completes the partial keys of any primary entities, allocating
+                the ids for each kind with a single RPC
+            """
+            partial = {}
+            for primary, descendents in entities:
+                if primary.key.is_partial:
+                    key = primary.key
+                    partial.setdefault((key.project, key.namespace, key.flat_path), []).append(primary)
+
+            for primaries in partial.values():
+                keys = rpc.allocate_ids(primaries[0].key, len(primaries))
+                for primary, key in zip(primaries, keys):
+                    primary.key = key
+
         def perform_insert(entities):
             results = []
             rpc = transaction._rpc(self.connection.alias)
             must_handle_unique = has_active_unique_constraints(self.model)
 
-            for primary, descendents in entities:
-                if primary.key.is_partial:
-                    primary.key = primary.key.completed_key(
-                        rpc._generate_id()
-                    )
+            allocate_keys(rpc, entities)
 
-                # thanks to cloud firestore in datastore mode strong consistency
-                # we can query for the relevant entities to enforce uniqueness
-                if must_handle_unique:
-                    perform_unique_checks(self.model, rpc, primary, test_fn=lambda stored: stored and len(stored) > 0)
+            # thanks to cloud firestore in datastore mode strong consistency
+            # we can query for the relevant entities to enforce uniqueness
+            if must_handle_unique:
+                perform_unique_checks(
+                    self.model, rpc, [primary for primary, _ in entities], using=self.connection.alias
+                )
 
-                rpc.put(primary)
+            to_put = []
+            for primary, descendents in entities:
                 new_key = primary.key
+                to_put.append(primary)
 
                 if descendents:
                     for i, descendent in enumerate(descendents):
@@ -702,27 +816,31 @@ class InsertCommand(object):
                         descendents[i] = Entity(key)
                         descendents[i].update(descendent)
 
-                    for descendent in descendents:
-                        rpc.put(descendent)
+                    to_put.extend(descendents)
 
                 results.append(new_key)
+
+            # Write all the primaries and descendents in one go
+            rpc.put_multi(to_put)
             return results
 
         @transaction.atomic(enable_cache=False)
         def insert_chunk(keys, entities):
-            for key in keys:
-                # sanity check the key isn't already taken
-                if check_existence and key is not None:
-                    if utils.key_exists(self.connection.alias, key):
-                        raise IntegrityError("Tried to INSERT with existing key")
+            if check_existence:
+                keys = [key for key in keys if key is not None]
 
+                for key in keys:
                     # quick validation of the ID value
                     id_or_name = key.id_or_name
                     if isinstance(id_or_name, str) and id_or_name.startswith("__"):
                         raise NotSupportedError("Datastore ids cannot start with __. Id was {}".format(id_or_name))
 
-                    # notify App Engine of any keys we're specifying intentionally
-                    reserve_id(self.connection, key.kind, key.id_or_name, self.namespace)
+                # sanity check the keys aren't already taken
+                if utils.keys_exist(self.connection.alias, keys):
+                    raise IntegrityError("Tried to INSERT with existing key")
+
+                # notify the Datastore of any keys we're specifying intentionally
+                reserve_ids(self.connection, keys)
 
             results = perform_insert(entities)
 
@@ -754,6 +872,100 @@ class InsertCommand(object):
         return generate_sql_representation(self)
 
 
+# The number of chunks committed at once by bulk_create_chunks
+DEFAULT_BULK_CREATE_CONCURRENCY = 4
+
+
+class BulkCreateChunk(object):
+    """
+        The outcome of creating one chunk of instances with bulk_create_chunks,
+        `error` is the exception which stopped the chunk being created (if any)
+    """
+
+    def __init__(self, objs, error=None):
+        self.objs = objs
+        self.error = error
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "<BulkCreateChunk of {} {}>".format(len(self.objs), "succeeded" if self.succeeded else "failed")
+
+
+def bulk_create_chunks(objs, using="default", chunk_size=None, concurrency=None):
+    """
+        Like bulk_create, but for when you'd rather have most of the instances
+        created than none of them. The instances are split into chunks (of the
+        connection's transaction entity limit by default), each of which is created
+        in its own transaction, with `concurrency` (GCLOUDC_BULK_CREATE_CONCURRENCY
+        by default) chunks being committed at once.
+
+        A chunk failing doesn't stop the others. Returns a BulkCreateChunk for each
+        chunk, in the order of `objs`, saying whether it was created.
+    """
+    objs = list(objs)
+    if not objs:
+        return []
+
+    if transaction.in_atomic_block(using):
+        raise NotSupportedError(
+            "bulk_create_chunks commits the chunks independently, so can't be used inside a transaction"
+        )
+
+    model = type(objs[0])
+    limit = transaction.get_entity_limit(using)
+    chunk_size = min(chunk_size or limit, limit)
+    if concurrency is None:
+        concurrency = getattr(settings, "GCLOUDC_BULK_CREATE_CONCURRENCY", DEFAULT_BULK_CREATE_CONCURRENCY)
+
+    chunks = [objs[i:i + chunk_size] for i in range(0, len(objs), chunk_size)]
+
+    def create(chunk):
+        try:
+            model._base_manager.db_manager(using).bulk_create(chunk)
+        except Exception as e:
+            logger.warning("Unable to create a chunk of %s %s instances: %s", len(chunk), model.__name__, e)
+            return BulkCreateChunk(chunk, e)
+        return BulkCreateChunk(chunk)
+
+    if concurrency <= 1 or len(chunks) == 1:
+        return [create(chunk) for chunk in chunks]
+
+    results = [None] * len(chunks)
+    pending = iter(enumerate(chunks))
+    lock = threading.Lock()
+
+    def worker():
+        # Each worker opens the connection on its thread once, and creates chunks
+        # until there are none left
+        connection = connections[using]
+        connection.ensure_connection()
+        try:
+            while True:
+                with lock:
+                    next_chunk = next(pending, None)
+
+                if next_chunk is None:
+                    return
+
+                i, chunk = next_chunk
+                results[i] = create(chunk)
+        finally:
+            # The pool's threads go away, but we don't want to leak their connections
+            connection.close()
+
+    # These run on their own pool rather than the RPC executor, as creating a chunk
+    # uses the executor itself
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        workers = [executor.submit(worker) for _ in range(min(concurrency, len(chunks)))]
+        for future in workers:
+            future.result()
+
+    return results
+
+
 class DeleteCommand(object):
     """
     Delete an entity / multiple entities.
@@ -779,6 +991,45 @@ class DeleteCommand(object):
             table = utils.get_top_concrete_parent(query.model)._meta.db_table
         self.table_to_delete = table  # used in wipe_polymodel_from_entity
 
+    def _iter_key_chunks(self, chunk_size):
+        """
+            Generates lists of (at most) chunk_size keys which match the query.
+
+            Plain Datastore queries are paged through with cursors so that the full
+            keyset is never held in memory, and each page picks up where the previous
+            one ended rather than re-running the query from the start.
+        """
+        rpc = transaction._rpc(self.connection.alias)
+        excluded_pks = set([rpc.key(x.kind, x.id_or_name) for x in self.select.query.excluded_pks])
+
+        query = self.select._build_query()
+
+        if isinstance(query, Query):
+            cursor = None
+            while True:
+                iterator = query.fetch(limit=chunk_size, start_cursor=cursor)
+                page = [x.key for x in iterator]
+                cursor = iterator.next_page_token
+
+                keys = [x for x in page if x not in excluded_pks]
+                if keys:
+                    yield keys
+
+                if len(page) < chunk_size or not cursor:
+                    break
+        else:
+            # Meta queries (e.g. lookups by key, or multi queries) don't support
+            # cursors, so we just chunk up their result set
+            results = query.fetch(limit=None, offset=None)
+            keys = (x if isinstance(x, Key) else x.key for x in results)
+            keys = (x for x in keys if x not in excluded_pks)
+
+            while True:
+                chunk = list(islice(keys, chunk_size))
+                if not chunk:
+                    break
+                yield chunk
+
     def execute(self):
         """
             Ideally we'd just be able to tell appengine to delete all the entities
@@ -791,9 +1042,15 @@ class DeleteCommand(object):
             And then there are polymodels (model inheritence) which means we might not even be
             deleting the entity after all, only deleting some of the fields from it.
 
-            What we do then is do a keys_only query, then iterate the entities in batches of
+            What we do then is page through a keys_only query in batches of
             500, each entity in the batch has its polymodel fields wiped out
             (if necessary) and then we do either a put() or delete() all inside a transaction.
+            Each batch is committed in its own transaction, and several batches can be
+            sent at once by setting GCLOUDC_BULK_DELETE_CONCURRENCY.
+
+            If a batch fails, the batches before it have already been committed. As deleted
+            entities no longer match the query, running the delete again picks up
+            with whatever remains.
 
             Oh, and we wipe out memcache in an independent transaction.
 
@@ -804,7 +1061,7 @@ class DeleteCommand(object):
         from .indexing import indexers_for_model
 
         @transaction.atomic()
-        def delete_batch(key_slice):
+        def delete_batch(keys_in_slice):
             """
                 Batch fetch entities, wiping out any polymodel fields if
                 necessary, before deleting the entities by key.
@@ -815,8 +1072,6 @@ class DeleteCommand(object):
             entities_to_update = []
             updated_keys = []
 
-            # get() expects Key objects, not just dicts with id keys
-            keys_in_slice = [get_datastore_key(self.connection, self.model, key_id) for key_id in key_slice]
             entities = transaction._rpc(self.connection.alias).get(keys_in_slice)
             for entity in entities:
 
@@ -839,11 +1094,8 @@ class DeleteCommand(object):
 
             client = transaction._rpc(self.connection.alias)
 
-            for entity in entities_to_delete:
-                client.delete(entity.key)
-
-            for entity in entities_to_update:
-                client.put(entity)
+            client.delete([entity.key for entity in entities_to_delete])
+            client.put_multi(entities_to_update)
 
             # Clean up any special indexes that need to be removed
             for indexer in indexers_for_model(self.model):
@@ -855,21 +1107,77 @@ class DeleteCommand(object):
 
             return len(updated_keys)
 
-        # grab the result of the keys only query (see __init__)
-        self.select.execute()
-        key_ids = [x[self.model._meta.pk.name] for x in self.select.results]
+        max_batch_size = transaction.get_entity_limit(self.connection.alias)
+        chunks = self._iter_key_chunks(max_batch_size)
+
+        if transaction.in_atomic_block(self.connection.alias):
+            # Inside an outer transaction everything is committed together, so
+            # we can't split the delete up into separate batches
+            keys = list(chain.from_iterable(chunks))
+            if len(keys) > max_batch_size:
+                raise BulkDeleteError(
+                    "Bulk deletes for {} can only delete {} instances inside a transaction".format(
+                        self.model, max_batch_size
+                    )
+                )
+            return delete_batch(keys)
 
-        # for now we can only process 500 entities
-        # otherwise we need to handle rollback of independent transactions
-        # and race conditions between items being deleted and restored...
-        max_batch_size = transaction.TRANSACTION_ENTITY_LIMIT
+        concurrency = getattr(settings, "GCLOUDC_BULK_DELETE_CONCURRENCY", DEFAULT_BULK_DELETE_CONCURRENCY)
 
-        if len(key_ids) > max_batch_size:
-            raise BulkDeleteError(
-                "Bulk deletes for {} can only delete {} instances per batch".format(self.model, max_batch_size)
+        deleted = 0
+        try:
+            if concurrency > 1:
+                for keys, count in self._delete_chunks_concurrently(delete_batch, chunks, concurrency):
+                    # Transactions (and their caches) are thread-local, so clean
+                    # up the cache of this thread once the batch has been committed
+                    remove_entities_from_cache_by_key(keys, self.namespace)
+                    deleted += count
+                    logger.debug("Deleted %s %s instances so far", deleted, self.model.__name__)
+            else:
+                for keys in chunks:
+                    deleted += delete_batch(keys)
+                    logger.debug("Deleted %s %s instances so far", deleted, self.model.__name__)
+        except Exception:
+            logger.warning(
+                "Bulk delete of %s failed after deleting %s instances, "
+                "running the delete again will continue with the remaining instances",
+                self.model.__name__, deleted
             )
+            raise
+
+        return deleted
+
+    def _delete_chunks_concurrently(self, delete_batch, chunks, concurrency):
+        """
+            Runs delete_batch on up to `concurrency` chunks at once, yielding
+            (keys, deleted_count) for each chunk as it completes. Only `concurrency`
+            chunks are ever pulled from the query ahead of the deletes.
+        """
+        alias = self.connection.alias
+
+        def run(keys):
+            try:
+                return delete_batch(keys)
+            finally:
+                # Each worker thread opens its own connection, which we don't want to leak
+                connections[alias].close()
 
-        return delete_batch(key_ids)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = {}
+            try:
+                for keys in chunks:
+                    if len(pending) >= concurrency:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield pending.pop(future), future.result()
+
+                    pending[executor.submit(run, keys)] = keys
+
+                for future in as_completed(list(pending)):
+                    yield pending.pop(future), future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
 
     def lower(self):
         """
@@ -900,6 +1208,32 @@ def _wipe_polymodel_from_entity(entity, db_table):
             entity["class"] = polymodel_value
 
 
+def _upsert_enabled(model):
+    """
+        Saving an existing instance normally reads the entity, applies the update and
+        writes it back in a transaction. Setting GCLOUDC_UPSERT_ON_SAVE (or listing
+        the model, by label, in GCLOUDC_UPSERT_MODELS) writes it with a single put instead.
+
+        The catch is that the entity is overwritten whether or not it still exists, so
+        saving an instance which was deleted in the meantime recreates it.
+    """
+    if getattr(settings, "GCLOUDC_UPSERT_ON_SAVE", False):
+        return True
+    return model._meta.label in getattr(settings, "GCLOUDC_UPSERT_MODELS", ())
+
+
+def _has_concrete_children(model):
+    return any(
+        hasattr(x, "_meta") and (not x._meta.proxy or _has_concrete_children(x))
+        for x in model.__subclasses__()
+    )
+
+
+# How many times an update without a transaction reads and writes an entity
+# which keeps being changed by other writes, before giving up
+OPTIMISTIC_UPDATE_ATTEMPTS = 5
+
+
 @python_2_unicode_compatible
 class UpdateCommand(object):
     def __init__(self, connection, query):
@@ -920,108 +1254,330 @@ class UpdateCommand(object):
         """
         return str(self).lower()
 
-    def _update_entity(self, key):
-        def update_txt():
-            result = transaction._rpc(self.connection.alias).get(key)
-            if result is None:
-                # Return false to indicate update failure
-                return False
+    def _apply_values(self, result):
+        """
+            Applies the values of this update to the entity `result` in memory,
+            returning the updated entity along with any descendents which need
+            to be written alongside it.
+        """
+        original_classes = list(result.get(POLYMODEL_CLASS_ATTRIBUTE, []))
+
+        instance_kwargs = {field.attname: value for field, param, value in self.values}
+
+        # Note: If you replace MockInstance with self.model, you'll find that some delete
+        # tests fail in the test app. This is because any unspecified fields would then call
+        # get_default (even though we aren't going to use them) which may run a query which
+        # fails inside this transaction. Given as we are just using MockInstance so that we can
+        # call django_instance_to_entities it on it with the subset of fields we pass in,
+        # what we have is fine.
+        meta = self.model._meta
+        instance = MockInstance(_original=MockInstance(_meta=meta, **result), _meta=meta, **instance_kwargs)
+
+        # Convert the instance to an entity
+        primary, descendents = django_instance_to_entities(
+            self.connection,
+            [x[0] for x in self.values],  # Pass in the fields that were updated
+            True,
+            instance,
+            model=self.model,
+        )
 
-            original = copy.deepcopy(result)
-
-            instance_kwargs = {field.attname: value for field, param, value in self.values}
-
-            # Note: If you replace MockInstance with self.model, you'll find that some delete
-            # tests fail in the test app. This is because any unspecified fields would then call
-            # get_default (even though we aren't going to use them) which may run a query which
-            # fails inside this transaction. Given as we are just using MockInstance so that we can
-            # call django_instance_to_entities it on it with the subset of fields we pass in,
-            # what we have is fine.
-            meta = self.model._meta
-            instance = MockInstance(_original=MockInstance(_meta=meta, **result), _meta=meta, **instance_kwargs)
-
-            # Convert the instance to an entity
-            primary, descendents = django_instance_to_entities(
-                self.connection,
-                [x[0] for x in self.values],  # Pass in the fields that were updated
-                True,
-                instance,
-                model=self.model,
+        # Update the entity we read above with the new values
+        result.update(primary)
+
+        # Remove fields which have been marked to be unindexed
+        for col in getattr(primary, "_properties_to_remove", []):
+            if col in result:
+                del result[col]
+
+        # Make sure that any polymodel classes which were in the original entity are kept,
+        # as django_instance_to_entities may have wiped them as well as added them.
+        polymodel_classes = list(set(original_classes + result.get(POLYMODEL_CLASS_ATTRIBUTE, [])))
+        if polymodel_classes:
+            result[POLYMODEL_CLASS_ATTRIBUTE] = polymodel_classes
+
+        return result, primary, self._reparent_descendents(descendents, result.key)
+
+    def _reparent_descendents(self, descendents, key):
+        # Descendents are written with the updated entity as their ancestor. This
+        # can run on the executor's threads, so we don't go through the (thread local)
+        # Django connection to get at the client
+        client = self.connection.connection.gclient
+        for i, descendent in enumerate(descendents):
+            descendents[i] = Entity(
+                client.key(
+                    descendent.kind,
+                    descendent.key.name if descendent.key.id is None else descendent.key.id,
+                    parent=key,
+                    namespace=self.namespace,
+                )
             )
+            descendents[i].update(descendent)
 
-            # Update the entity we read above with the new values
-            result.update(primary)
+        return descendents
 
-            # Remove fields which have been marked to be unindexed
-            for col in getattr(primary, "_properties_to_remove", []):
-                if col in result:
-                    del result[col]
+    def _update_entities(self, keys):
+        """
+            Reads all the entities for `keys` with a single Get, applies the
+            update to each of them in memory and then writes them back (along with any
+            descendents) with a single batched Put.
 
-            # Make sure that any polymodel classes which were in the original entity are kept,
-            # as django_instance_to_entities may have wiped them as well as added them.
-            polymodel_classes = list(
-                set(original.get(POLYMODEL_CLASS_ATTRIBUTE, []) + result.get(POLYMODEL_CLASS_ATTRIBUTE, []))
-            )
-            if polymodel_classes:
-                result[POLYMODEL_CLASS_ATTRIBUTE] = polymodel_classes
+            Returns the number of entities which were updated.
+        """
+        client = transaction._rpc(self.connection.alias)
+        must_handle_unique = has_active_unique_constraints(self.model)
 
-            def perform_insert():
-                """
-                    Inserts result, and any descendents with their ancestor
-                    value set
-                """
-                client = transaction._rpc(self.connection.alias)
+        to_put = []
+        updated = []
+        primaries = []
 
-                def test_fn(stored):
-                    return stored and len(stored) == 1 and stored[0].key != result.key
+        # Entities which no longer exist aren't returned, so won't be updated
+        for result in client.get(keys) or []:
+            result, primary, descendents = self._apply_values(result)
 
-                if has_active_unique_constraints(self.model):
-                    perform_unique_checks(self.model, client, primary, test_fn)
+            # The primary only contains the updated fields, but we need the
+            # key to tell apart the entity from any clashing ones
+            primary.key = result.key
+            primaries.append(primary)
 
-                inserted_key = client.put(result)
-                self.results.append((result, None))
+            to_put.append(result)
+            to_put.extend(descendents)
+            updated.append(result)
 
-                if descendents:
-                    for i, descendent in enumerate(descendents):
-                        descendents[i] = Entity(
-                            client.key(
-                                descendent.kind,
-                                descendent.key.name if descendent.key.id is None else descendent.key.id,
-                                parent=inserted_key,
-                            )
-                        )
-                        descendents[i].update(descendent)
-                    client.put_multi(descendents)
+        if must_handle_unique:
+            perform_unique_checks(self.model, client, primaries, using=self.connection.alias)
 
+        if to_put:
             # this will be async as we're inside a transaction block
-            perform_insert()
+            client.put_multi(to_put)
+
+        self.results.extend([(result, None) for result in updated])
+
+        # Update the cache with the entities
+        caching.add_entities_to_cache(
+            self.model,
+            updated,
+            caching.CachingSituation.DATASTORE_PUT,
+            self.namespace
+        )
+
+        return len(updated)
+
+    def _upsert_key(self):
+        """
+            Returns the key of the entity if this update can be written as a single
+            blind put (see _upsert), otherwise None.
+        """
+        if not _upsert_enabled(self.model):
+            return None
+
+        # Polymodel entities hold the fields of the other models in the hierarchy,
+        # which a put of just this model's fields would wipe out
+        if has_concrete_parents(self.model) or _has_concrete_children(self.model):
+            return None
+
+        # The update must set every field, to values we know without reading
+        # the entity (so no F() expressions)
+        non_pks = set(x for x in self.model._meta.concrete_fields if not x.primary_key)
+        if set(field for field, _, _ in self.values) != non_pks:
+            return None
+
+        if any(hasattr(value, "resolve_expression") for _, _, value in self.values):
+            return None
+
+        # ...of a single entity, looked up by its key
+        query = self.select.query
+        if query.excluded_pks or not query.where or len(query.where.children) != 1:
+            return None
+
+        branch = query.where.children[0]
+        leaves = [branch] if branch.is_leaf else branch.children
+        if len(leaves) != 1 or not leaves[0].is_leaf or leaves[0].negated:
+            return None
+
+        leaf = leaves[0]
+        if (leaf.column, leaf.operator) != ("__key__", "=") or not isinstance(leaf.value, Key):
+            return None
+
+        return leaf.value
+
+    def _upsert(self, key):
+        """
+            Writes the entity with a single put, rather than reading it, applying
+            the update and writing it back. Used when saving a model instance,
+            which sets every field. If the entity doesn't exist it's created, like
+            the INSERT which Django would have done next.
+        """
+        meta = self.model._meta
+        instance = MockInstance(_meta=meta, **{field.attname: value for field, _, value in self.values})
+
+        primary, descendents = django_instance_to_entities(
+            self.connection, [x[0] for x in self.values], True, instance, model=self.model
+        )
+        primary.key = key
+        descendents = self._reparent_descendents(descendents, key)
+
+        # The unique checks need a transaction so nothing can take the values
+        # between checking and writing, but otherwise a put is atomic by itself
+        must_handle_unique = has_active_unique_constraints(self.model, ignore_pk=True)
+
+        def put():
+            client = transaction._rpc(self.connection.alias)
+
+            if must_handle_unique:
+                perform_unique_checks(self.model, client, [primary], using=self.connection.alias)
+
+            client.put_multi([primary] + descendents)
 
-            # Update the cache with the entity
             caching.add_entities_to_cache(
                 self.model,
-                [result],
+                [primary],
                 caching.CachingSituation.DATASTORE_PUT,
                 self.namespace
             )
 
-            # Return true to indicate update success
-            return True
+        if must_handle_unique:
+            transaction.atomic(enable_cache=False)(put)()
+        else:
+            put()
+
+        self.results.append((primary, None))
+        return 1
+
+    def _update_entities_optimistically(self, keys):
+        """
+            Reads the entities for `keys` along with their versions, applies the update
+            to them in memory and writes them back with a non-transactional commit
+            which only applies each write if the entity's version hasn't changed since
+            we read it. Entities which were changed in the meantime are read and
+            updated again, up to OPTIMISTIC_UPDATE_ATTEMPTS times.
+
+            This makes no use of the context cache, so that it can run on the executor's
+            threads, but the indexers look keys up through the Django connection, which
+            must be open on the thread. Returns the updated entities.
+        """
+        client = self.connection.connection.gclient
+
+        updated = []
+        remaining = keys
+        for attempt in range(OPTIMISTIC_UPDATE_ATTEMPTS):
+            results = client_compat.lookup_with_versions(client, remaining)
+
+            to_put = []
+            descendents_by_key = {}
+            for result, version in results:
+                result, _, descendents = self._apply_values(result)
+                to_put.append((result, version))
+                descendents_by_key[result.key] = descendents
+
+            if not to_put:
+                break
+
+            written, changed = client_compat.put_if_unchanged(client, to_put)
+            remaining = [x.key for x in changed]
+
+            # Descendents are only written once their entity has been, otherwise
+            # they'd be indexing values the entity doesn't have
+            descendents = list(chain.from_iterable(descendents_by_key[x.key] for x in written))
+            if descendents:
+                client.put_multi(descendents)
+
+            updated.extend(written)
+
+            if not remaining:
+                break
+        else:
+            raise transaction.TransactionFailedError(
+                "Unable to update {} {} instances, they kept being changed by other writes".format(
+                    len(remaining), self.model.__name__
+                )
+            )
+
+        return updated
+
+    def _execute_optimistically(self, keys):
+        chunk_size = transaction.get_entity_limit(self.connection.alias)
+        chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
 
-        return update_txt()
+        updated = []
+        # A chunk which failed might still have written some of its entities
+        failed_keys = []
+
+        try:
+            if len(chunks) > 1:
+                alias = self.connection.alias
+
+                def update_chunk(chunk):
+                    connection = connections[alias]
+                    opened = not connection.connection
+                    if opened:
+                        connection.connect()
+
+                    try:
+                        return self._update_entities_optimistically(chunk)
+                    finally:
+                        # The executor's threads are long lived, we don't want to leak the
+                        # connection we opened on this one
+                        if opened:
+                            connection.close()
+
+                executor = get_executor()
+                futures = [executor.submit(update_chunk, chunk) for chunk in chunks]
+
+                # The other chunks carry on if one fails, so we wait for all of them
+                # to know what was written before raising the first error
+                wait(futures)
+                for chunk, future in zip(chunks, futures):
+                    if future.exception() is None:
+                        updated.extend(future.result())
+                    else:
+                        failed_keys.extend(chunk)
+
+                for future in futures:
+                    future.result()
+            elif chunks:
+                try:
+                    updated = self._update_entities_optimistically(chunks[0])
+                except Exception:
+                    failed_keys = chunks[0]
+                    raise
+        finally:
+            # The writes have already happened, so the caches are brought up to date now
+            caching.remove_entities_from_shared_cache([x.key for x in updated] + failed_keys)
+            remove_entities_from_cache_by_key(failed_keys, self.namespace)
+            caching.add_entities_to_cache(
+                self.model,
+                updated,
+                caching.CachingSituation.DATASTORE_PUT,
+                self.namespace
+            )
+
+        self.results.extend([(result, None) for result in updated])
+        return len(updated)
 
     def execute(self):
+        upsert_key = self._upsert_key()
+        if upsert_key is not None:
+            return self._upsert(upsert_key)
+
+        # Transactions are only needed for the unique checks, without any unique constraints
+        # we read and write the entities in concurrent chunks, each write checking the entity
+        # hasn't changed since it was read. Inside a transaction the writes have to be part of it
+        optimistic = (
+            getattr(settings, "GCLOUDC_OPTIMISTIC_UPDATES", True)
+            and not has_active_unique_constraints(self.model, ignore_pk=True)
+            and not transaction.in_atomic_block(self.connection.alias)
+        )
+
+        if optimistic:
+            self.select.execute()
+            return self._execute_optimistically([x.key for x in self.select.results])
+
         must_handle_unique = has_active_unique_constraints(self.model)
 
-        # TODO: potential optimisation - only use transaction if updating things
-        # that require unique checks. This could potentially open a can of worms
-        # but would have the benefit of removing any per-commit limits the datastore
-        # currently imposes on transactions
         @transaction.atomic(enable_cache=False)
-        def perform_update(results):
-            i = 0
-            for result in results:
-                if self._update_entity(result.key):
-                    i += 1
+        def perform_update(keys):
+            count = self._update_entities(keys)
 
             # due to the isolation of the datastore inside transactions we won't
             # find unique clashes as part of the bulk operation. To avoid this
@@ -1029,7 +1585,7 @@ class UpdateCommand(object):
             if must_handle_unique:
                 check_unique_markers_in_memory(self.model, self.results)
 
-            return i
+            return count
 
         self.select.execute()
         results = list(self.select.results)
@@ -1045,4 +1601,13 @@ class UpdateCommand(object):
                 if set(combination) == updating_attributes:
                     raise IntegrityError('UPDATE on {} field(s) violates unique constraint'.format(combination))
 
-        return perform_update(results)
+        # Each transaction can only write a limited number of entities, so
+        # we read and write in chunks, with one Get and one Put per chunk
+        keys = [x.key for x in results]
+        chunk_size = transaction.get_entity_limit(self.connection.alias)
+
+        updated = 0
+        for i in range(0, len(keys), chunk_size):
+            updated += perform_update(keys[i:i + chunk_size])
+
+        return updated
@@ -15,6 +15,7 @@ from .unique_utils import (
     unique_identifiers_from_entity,
     _has_enabled_constraints,
     _has_unique_constraints,
+    _unique_combinations,
 )
 
 
@@ -22,17 +23,23 @@ UNIQUE_MARKER_KIND = "uniquemarker"
 CONSTRAINT_VIOLATION_MSG = "Unique constraint violation for kind {} on fields: {}"
 
 
-def has_active_unique_constraints(model_or_instance):
+def has_active_unique_constraints(model_or_instance, ignore_pk=False):
     """
     Returns a boolean to indicate if we should respect any unique constraints
     defined on the provided instance / model, taking into account any model
     or global related flags.
+
+    Every model has the implicit constraint of its primary key, which the
+    Datastore enforces for us, passing ignore_pk=True leaves that one out.
     """
     # are unique constraints disabled on the provided model take precident
     constraints_enabled = _has_enabled_constraints(model_or_instance)
     if not constraints_enabled:
         return False
 
+    if ignore_pk:
+        return bool(_unique_combinations(model_or_instance._meta.model, ignore_pk=True))
+
     # does the object have unique constraints defined in the model definition
     return _has_unique_constraints(model_or_instance)
 
@@ -1,24 +1,23 @@
 import copy
 import sys
+import threading
+import time
+from collections import OrderedDict
 
 from django.conf import settings
 
+from google.cloud.datastore import helpers
+from google.cloud.datastore.entity import Entity
 from google.cloud.datastore.key import Key
+from google.cloud.datastore_v1.proto import entity_pb2
 
 
-def key_or_entity_compare(lhs, rhs):
+def _entity_key(value):
     """
-        Returns true if lhs is an entity with a key that matches rhs or
-        if lhs is a key which matches rhs, or if lhs is a key which maches
-        rhs.key()
+        Returns the datastore Key of the value if it's an entity, otherwise None
     """
-    if hasattr(rhs, "key"):
-        rhs = rhs.key
-
-    if hasattr(lhs, "key"):
-        lhs = lhs.key
-
-    return lhs == rhs
+    key = getattr(value, "key", None)
+    return key if isinstance(key, Key) else None
 
 
 # 8M default cache size. Fairly arbitrary but the lowest instance class (F1) has 128M
@@ -26,33 +25,77 @@ def key_or_entity_compare(lhs, rhs):
 # so we use 50% of that by default.
 DEFAULT_MAX_CACHE_DICT_SIZE = 1024 * 1024 * 8
 MAX_CACHE_DICT_SETTING_NAME = "DJANGAE_CACHE_MAX_CONTEXT_SIZE"
+DEBUG_CHECKS_SETTING_NAME = "GCLOUDC_CACHE_DEBUG_CHECKS"
+
+# Storing entities as protobuf bytes trades CPU for memory. The cache's size limit
+# then bounds the real memory used (sys.getsizeof only measures a shallow dict, so
+# copies can use several times the limit) and cached entities take less space, but
+# every read and write has to (de)serialize. With the pure Python protobuf runtime
+# that's over twice as slow as the deep copies it replaces (see benchmarks/cache_dict.py),
+# so it's off by default, and mostly worth it with the C++ runtime or when memory is tight.
+SERIALIZE_ENTITIES_SETTING_NAME = "GCLOUDC_CACHE_SERIALIZE_ENTITIES"
+
+
+class SerializedEntity(object):
+    """
+        An entity stored as its serialized protobuf. Loading it builds a new
+        Entity each time, and the size of the bytes is the real memory cost
+        of the cached entity.
+    """
+
+    __slots__ = ("key", "data")
+
+    def __init__(self, entity):
+        self.key = entity.key
+        self.data = helpers.entity_to_protobuf(entity).SerializeToString()
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def load(self):
+        return helpers.entity_from_protobuf(entity_pb2.Entity.FromString(self.data))
 
 
 class CacheDict(object):
     """
         This is a special dictionary-like object which does the following:
 
-        1. Copies items in and out to prevent storing references
+        1. Copies items in and out to prevent storing references (or, with
+           serialize_entities, stores entities as protobuf bytes)
         2. The cache dict is restricted to a maximum size in bytes
-        3. Unaccessed entries are removed first
+        3. Least recently used entries are removed first
 
         The priority of eviction is based on the *value* and not the *keys*. If multiple
         keys point to the same object reference then an access to any of them will mark the
         value as used, if a value is evicted, all the keys pointing to it are removed.
+
+        Getting, setting and evicting are all O(1), the priorities are kept in an
+        OrderedDict which is reordered on access rather than searched.
     """
 
-    def __init__(self, max_size_in_bytes=None):
+    def __init__(self, max_size_in_bytes=None, debug_checks=None, serialize_entities=None):
         max_size_in_bytes = max_size_in_bytes or getattr(
             settings, MAX_CACHE_DICT_SETTING_NAME, DEFAULT_MAX_CACHE_DICT_SIZE
         )
 
-        # This is a list of `id(value)` values in priority of most recently used
-        # to least recently used
-        self.value_priority = []
+        if debug_checks is None:
+            debug_checks = getattr(settings, DEBUG_CHECKS_SETTING_NAME, False)
+
+        if serialize_entities is None:
+            serialize_entities = getattr(settings, SERIALIZE_ENTITIES_SETTING_NAME, False)
+
+        # An ordered dict of `id(value)`: size in bytes, from least recently used
+        # to most recently used
+        self.value_priority = OrderedDict()
 
         # This is a reverse lookup dict of id(value): {key1, key2, ...}
         self.value_references = {}
 
+        # This is a reverse lookup dict of the datastore Key of each value (when the
+        # value is an entity) to the keys it's cached under: {Key: {key1, key2, ...}}
+        self.key_references = {}
+
         # The actual entries, values are normally entities but it makes it easy to
         # understand this class if you think of them as the references they are.
         # Multiple keys can map to the same entity reference
@@ -64,11 +107,39 @@ class CacheDict(object):
         # The max size in bytes that the total values can become
         self.max_size_in_bytes = max_size_in_bytes
 
+        # When set, the internal bookkeeping is verified after every change. This
+        # is O(n) per operation so should only be enabled when debugging the cache
+        self.debug_checks = debug_checks
+
+        # When set, entities are stored as SerializedEntity rather than copies
+        self.serialize_entities = serialize_entities
+
     def __deepcopy__(self, memo):
         new_one = CacheDict()
         new_one.update(self)
         return new_one
 
+    def _check_consistency(self):
+        assert set([id(x) for x in self._entries.values()]) == set(self.value_priority)
+        assert set(self.value_priority) == set(self.value_references)
+        assert self.total_value_size == sum(self.value_priority.values())
+        assert sum(len(x) for x in self.key_references.values()) == len(
+            [x for x in self._entries.values() if _entity_key(x) is not None]
+        )
+
+    def _add_key_reference(self, k, v):
+        entity_key = _entity_key(v)
+        if entity_key is not None:
+            self.key_references.setdefault(entity_key, set()).add(k)
+
+    def _remove_key_reference(self, k, v):
+        entity_key = _entity_key(v)
+        if entity_key is not None:
+            references = self.key_references[entity_key]
+            references.discard(k)
+            if not references:
+                del self.key_references[entity_key]
+
     def _set_value(self, k, v):
         """
             Sets a value in the _entries dictionary but manages the associated
@@ -87,6 +158,7 @@ class CacheDict(object):
             old_key = id(old_value)
 
             self.value_references[old_key].remove(k)
+            self._remove_key_reference(k, old_value)
             del self._entries[k]
 
             if not self.value_references[old_key]:
@@ -94,17 +166,17 @@ class CacheDict(object):
 
         priority_key = id(v)
 
-        existing_value = priority_key in self.value_priority
-
         self.value_references.setdefault(priority_key, set()).add(k)
-        if priority_key not in self.value_priority:
-            self.value_priority.insert(len(self.value_priority) // 2, priority_key)
+        if priority_key in self.value_priority:
+            self.value_priority.move_to_end(priority_key)
+        else:
+            # If we added a new value to the dict, we increase the used size
+            size = v.size if isinstance(v, SerializedEntity) else sys.getsizeof(v)
+            self.value_priority[priority_key] = size
+            self.total_value_size += size
 
         self._entries[k] = v
-
-        # If we added a new value to the dict, we increase the used size
-        if not existing_value:
-            self.total_value_size += sys.getsizeof(v)
+        self._add_key_reference(k, v)
 
     def _check_size_and_limit(self):
         """
@@ -112,7 +184,7 @@ class CacheDict(object):
             we remove entities by deleting all their associated keys
         """
         while self.total_value_size > self.max_size_in_bytes:
-            next_priority_key = self.value_priority[-1]
+            next_priority_key = next(iter(self.value_priority))
 
             # We intentionally copy the result with list() as this will be manipulated
             # in del self[reference]
@@ -123,6 +195,9 @@ class CacheDict(object):
         self._set_value(k, v)
         self._check_size_and_limit()
 
+        if self.debug_checks:
+            self._check_consistency()
+
     def set_multi(self, keys, value):
         """
             This is the only public setting API because we don't want to
@@ -131,7 +206,7 @@ class CacheDict(object):
             of the cached value
         """
 
-        value = copy.deepcopy(value)  # Copy once
+        value = self._store(value)  # Copy once
         for k in set(keys):
             # Set the same value for multiple keys
             self._set(k, value)
@@ -139,20 +214,38 @@ class CacheDict(object):
     def __getitem__(self, k):
         v = self._entries[k]  # Find the entry
 
-        # Move the value up the value priority (remove the id() and add it back at the front)
-        priority_key = id(v)
-        self.value_priority.remove(priority_key)
-        self.value_priority.insert(0, priority_key)
+        # Move the value to the most recently used end of the priorities
+        self.value_priority.move_to_end(id(v))
+        return self._load(v)
+
+    def _store(self, value):
+        """
+            Returns the (copied) representation of value which is stored in the dict
+        """
+        if isinstance(value, SerializedEntity):
+            # These are immutable, so can be shared (e.g. when updating from another CacheDict)
+            return value
+
+        if self.serialize_entities and isinstance(value, Entity) and value.key is not None:
+            return SerializedEntity(value)
+
+        return copy.deepcopy(value)
+
+    def _load(self, v):
+        """
+            Returns a copy of a stored value for the caller
+        """
+        if isinstance(v, SerializedEntity):
+            return v.load()
+
         return copy.deepcopy(v)
 
     def _purge_value(self, v):
         priority_key = id(v)
         del self.value_references[priority_key]
-        self.value_priority.remove(priority_key)
-        self.total_value_size -= sys.getsizeof(v)
+        self.total_value_size -= self.value_priority.pop(priority_key)
 
     def __delitem__(self, k):
-        assert set([id(x) for x in self._entries.values()]) == set(self.value_priority)
         v = self._entries[k]
         priority_key = id(v)
 
@@ -162,9 +255,11 @@ class CacheDict(object):
         if not self.value_references[priority_key]:
             self._purge_value(v)
 
+        self._remove_key_reference(k, v)
         del self._entries[k]
 
-        assert set([id(x) for x in self._entries.values()]) == set(self.value_priority)
+        if self.debug_checks:
+            self._check_consistency()
 
     def __repr__(self):
         return "{%s}" % ", ".join([":".join([repr(k), repr(v)]) for k, v in self.items()])
@@ -174,7 +269,7 @@ class CacheDict(object):
         return len(unshared_items) == 0
 
     def __contains__(self, k):
-        return k in self.keys()
+        return k in self._entries
 
     def update(self, other):
         """
@@ -219,23 +314,146 @@ class CacheDict(object):
         for k in self.keys():
             # Intentionally don't reorganize the key priority if we're iterating
             # that would be *slow* and unlikely to lead to what you want
-            yield (k, copy.deepcopy(self._entries[k]))
+            yield (k, self._load(self._entries[k]))
 
-    def get_reversed(self, value, compare_func=None):
+    def keys_for_entity_key(self, key):
+        """
+            Returns the keys which the entity with the datastore Key `key`
+            is cached under, without scanning the entries
         """
-            Returns the keys for the specified value.
+        return list(self.key_references.get(key, ()))
+
+
+class ExpiringCacheDict(CacheDict):
+    """
+        A CacheDict where values also expire `timeout` seconds after they were set
+    """
+
+    def __init__(self, timeout, **kwargs):
+        super(ExpiringCacheDict, self).__init__(**kwargs)
+        self.timeout = timeout
+
+        # id(value): the time.monotonic() after which the value has expired
+        self.value_expiry = {}
+
+    def _set_value(self, k, v):
+        super(ExpiringCacheDict, self)._set_value(k, v)
+        self.value_expiry[id(v)] = time.monotonic() + self.timeout
+
+    def _purge_value(self, v):
+        super(ExpiringCacheDict, self)._purge_value(v)
+        del self.value_expiry[id(v)]
+
+    def __getitem__(self, k):
+        v = self._entries[k]
+
+        priority_key = id(v)
+        if self.value_expiry[priority_key] <= time.monotonic():
+            for reference in list(self.value_references[priority_key]):
+                del self[reference]
+            raise KeyError(k)
+
+        return super(ExpiringCacheDict, self).__getitem__(k)
 
-            If compare_func is specified then it will be called for
-            each value in the cache dict with value until compare_func
-            returns True
+
+class SharedCache(object):
+    """
+        A cache of entities which is shared by all the threads of the process, so
+        that unlike the context cache it lives on between requests. Entries are
+        evicted when they expire, or least recently used first once the byte budget
+        is used up. Entities are stored serialized, so reads don't share state.
+
+        An entity read from the datastore just before another thread wrote it mustn't
+        be put back after the write invalidated it. So every invalidation bumps a
+        generation, readers take the generation before they read and entities which
+        were invalidated since then aren't cached. Invalidations are remembered for
+        `timeout` seconds (and at most MAX_INVALIDATIONS of them), reads which took
+        longer than that aren't cached at all.
+    """
+
+    MAX_INVALIDATIONS = 10000
+
+    def __init__(self, max_size_in_bytes, timeout):
+        self._lock = threading.Lock()
+        self._cache = ExpiringCacheDict(
+            timeout, max_size_in_bytes=max_size_in_bytes, serialize_entities=True
+        )
+
+        self._generation = 0
+
+        # The recently invalidated keys, oldest first: {Key: (generation, time.monotonic())}
+        self._invalidations = OrderedDict()
+
+        # The invalidations up to this generation have been forgotten
+        self._forgotten_generation = 0
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def get(self, identifier):
+        with self._lock:
+            return self._cache.get(identifier)
+
+    def get_by_key(self, key):
+        with self._lock:
+            identifiers = self._cache.keys_for_entity_key(key)
+            return self._cache.get(identifiers[0]) if identifiers else None
+
+    def invalidated_since(self, key, generation):
+        with self._lock:
+            return self._invalidated_since(key, generation)
+
+    def _invalidated_since(self, key, generation):
+        if generation < self._forgotten_generation:
+            return True
+
+        invalidation = self._invalidations.get(key)
+        return invalidation is not None and invalidation[0] > generation
+
+    def set_multi(self, identifiers, entity, generation):
+        """
+            Caches the entity under the identifiers, unless it was invalidated
+            after `generation`, which should be taken before the entity was read
         """
-        results = []
-        for k, v in self._entries.items():
-            if compare_func and compare_func(v, value):
-                results.append(k)
-            elif v == value:
-                results.append(k)
-        return results
+        # Serialize outside of the lock, there's no need to hold up other threads
+        entity = SerializedEntity(entity)
+        with self._lock:
+            if not self._invalidated_since(entity.key, generation):
+                self._cache.set_multi(identifiers, entity)
+
+    def remove_keys(self, keys):
+        with self._lock:
+            self._generation += 1
+            now = time.monotonic()
+
+            for key in keys:
+                self._invalidations.pop(key, None)
+                self._invalidations[key] = (self._generation, now)
+
+                for identifier in self._cache.keys_for_entity_key(key):
+                    del self._cache[identifier]
+
+            while self._invalidations:
+                key, (generation, invalidated) = next(iter(self._invalidations.items()))
+                if len(self._invalidations) <= self.MAX_INVALIDATIONS and now - invalidated < self._cache.timeout:
+                    break
+
+                del self._invalidations[key]
+                self._forgotten_generation = generation
+
+    def clear(self):
+        with self._lock:
+            self._cache = ExpiringCacheDict(
+                self._cache.timeout,
+                max_size_in_bytes=self._cache.max_size_in_bytes,
+                serialize_entities=True,
+            )
+
+            # Anything being read now might have been invalidated, so it isn't cached
+            self._generation += 1
+            self._forgotten_generation = self._generation
+            self._invalidations = OrderedDict()
 
 
 class ContextCache(object):
@@ -283,9 +501,9 @@ class Context(object):
 
     def remove_entity(self, entity_or_key):
         if not isinstance(entity_or_key, Key):
-            entity_or_key = entity_or_key.key()
+            entity_or_key = entity_or_key.key
 
-        for identifier in self.cache.get_reversed(entity_or_key, compare_func=key_or_entity_compare):
+        for identifier in self.cache.keys_for_entity_key(entity_or_key):
             del self.cache[identifier]
 
     def get_entity(self, identifier):
@@ -293,7 +511,7 @@ class Context(object):
 
     def get_entity_by_key(self, key):
         try:
-            identifier = self.cache.get_reversed(key, compare_func=key_or_entity_compare)[0]
+            identifier = self.cache.keys_for_entity_key(key)[0]
         except IndexError:
             return None
         return self.get_entity(identifier)
@@ -335,7 +553,7 @@ class ContextStack(object):
         if apply_staged:
             while self.staged:
                 to_apply = self.staged.pop()
-                keys = [x.key for x in to_apply.cache.values()]
+                keys = list(to_apply.cache.key_references)
                 if keys:
                     # This assumes that all keys are in the same namespace,
                     # which is almost definitely
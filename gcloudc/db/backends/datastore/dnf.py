@@ -1,4 +1,5 @@
 import copy
+from collections import OrderedDict
 from itertools import product
 
 from django.conf import settings
@@ -7,9 +8,13 @@ from django.db.models.sql.datastructures import EmptyResultSet
 
 from .query import WhereNode
 
-# Maximum number of subqueries in a multiquery
+# Maximum number of subqueries in a multiquery that are run at the same time
 DEFAULT_MAX_ALLOWABLE_QUERIES = 100
 
+# Multiqueries with more subqueries than that are run in waves, this is the
+# maximum number of waves
+DEFAULT_MAX_QUERY_WAVES = 10
+
 
 def preprocess_node(node, negated):
 
@@ -207,11 +212,13 @@ def normalize_query(query):
             break
 
     MAX_ALLOWABLE_QUERIES = getattr(settings, "DJANGAE_MAX_QUERY_BRANCHES", DEFAULT_MAX_ALLOWABLE_QUERIES)
+    MAX_QUERY_WAVES = getattr(settings, "GCLOUDC_MAX_QUERY_WAVES", DEFAULT_MAX_QUERY_WAVES)
 
-    if (not all_pks) and len(query.where.children) > MAX_ALLOWABLE_QUERIES:
+    if (not all_pks) and len(query.where.children) > MAX_ALLOWABLE_QUERIES * MAX_QUERY_WAVES:
         raise NotSupportedError(
-            "Unable to run query as it required more than {} subqueries (limit is configurable with DJANGAE_MAX_QUERY_BRANCHES)".format(
-                MAX_ALLOWABLE_QUERIES
+            "Unable to run query as it required more than {} subqueries (limit is configurable with "
+            "DJANGAE_MAX_QUERY_BRANCHES and GCLOUDC_MAX_QUERY_WAVES)".format(
+                MAX_ALLOWABLE_QUERIES * MAX_QUERY_WAVES
             )
         )
 
@@ -307,3 +314,88 @@ def normalize_query(query):
     remove_unnecessary_nodes(query.where)
 
     return query
+
+
+def normalize_key_lookup(query):
+    """
+        Lookups of a list of keys (e.g. pk__in=[...]) ANDed with simple filters
+        would be exploded into a branch per key by normalize_query, only to be
+        turned back into a datastore Get of the keys. Here we normalize them
+        straight into a single branch which keeps the keys in one IN filter.
+
+        Returns the normalized query, or None if the (prepared) query isn't that
+        sort of lookup.
+    """
+    where = query.where
+    if where is None:
+        return None
+
+    leaves = []
+
+    def walk(node):
+        if node.is_leaf:
+            leaves.append(node)
+            return True
+
+        if node.negated or node.connector != "AND":
+            return False
+
+        return all(walk(child) for child in node.children)
+
+    if not walk(where):
+        return None
+
+    keys = None
+    filters = []
+    for leaf in leaves:
+        if leaf.will_never_return_results:
+            return None
+
+        if leaf.column == "__key__":
+            if leaf.operator == "IN":
+                values = leaf.value
+            elif leaf.operator == "=":
+                values = [leaf.value]
+            else:
+                return None
+
+            if keys is None:
+                # De-duplicate, keeping the order the keys were asked for in
+                keys = list(OrderedDict.fromkeys(values))
+            else:
+                values = set(values)
+                keys = [x for x in keys if x in values]
+        elif leaf.operator == "ISNULL":
+            # The same as preprocess_node does for isnull lookups
+            new_leaf = WhereNode(leaf.using)
+            new_leaf.column = leaf.column
+            new_leaf.operator = "=" if leaf.value else ">"
+            new_leaf.value = None
+            filters.append(new_leaf)
+        elif leaf.operator in ("=", "<", "<=", ">", ">=") and not isinstance(leaf.value, (list, tuple)):
+            filters.append(leaf)
+        else:
+            return None
+
+    # Leave single key lookups, and empty lists of keys, to the usual path
+    if not keys or not any(x.column == "__key__" and x.operator == "IN" for x in leaves):
+        return None
+
+    key_filter = WhereNode(where.using)
+    key_filter.column = "__key__"
+    key_filter.operator = "IN"
+    key_filter.value = keys
+
+    if filters:
+        branch = WhereNode(where.using)
+        branch.connector = "AND"
+        branch.children = filters + [key_filter]
+    else:
+        branch = key_filter
+
+    root = WhereNode(where.using)
+    root.connector = "OR"
+    root.children = [branch]
+
+    query.where = root
+    return query
@@ -0,0 +1,115 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+# Testing seems to show that more threads == better, but I'm concerned if we
+# raise this too high we'll start hitting bottlenecks elsewhere. Serious performance
+# testing needs to happen before this default is raised.
+DEFAULT_THREAD_COUNT = 8
+
+# The number of tasks that can be waiting for a thread before submitting more
+# blocks until some of them finish
+DEFAULT_QUEUE_SIZE = 256
+
+_lock = threading.Lock()
+_executor = None
+
+
+class RPCExecutor(object):
+    """
+        A thread pool for running datastore RPCs concurrently, which applies
+        back-pressure: once `queue_size` tasks are waiting for a thread, submit()
+        blocks until one of them is done rather than queueing without limit.
+
+        Tasks must not submit (and wait for) other tasks themselves, otherwise
+        they could end up waiting for a thread they are occupying.
+    """
+
+    def __init__(self, thread_count, queue_size):
+        self.thread_count = thread_count
+        self.queue_size = queue_size
+
+        self._executor = ThreadPoolExecutor(max_workers=thread_count, thread_name_prefix="gcloudc-rpc")
+        self._slots = threading.BoundedSemaphore(thread_count + queue_size)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._in_flight = 0
+
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self._queued -= 1
+            self._in_flight += 1
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+
+        with self._lock:
+            self._queued += 1
+
+        try:
+            future = self._executor.submit(self._run, fn, args, kwargs)
+        except Exception:
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    def metrics(self):
+        """
+            Returns the number of tasks waiting for a thread (queue_depth) and
+            the number currently running (in_flight)
+        """
+        with self._lock:
+            return {
+                "queue_depth": self._queued,
+                "in_flight": self._in_flight,
+                "thread_count": self.thread_count,
+                "queue_size": self.queue_size,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def get_executor():
+    """
+        Returns the process-wide executor, creating it from the
+        GCLOUDC_RPC_THREAD_COUNT and GCLOUDC_RPC_QUEUE_SIZE settings the first time
+    """
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = RPCExecutor(
+                getattr(settings, "GCLOUDC_RPC_THREAD_COUNT", DEFAULT_THREAD_COUNT),
+                getattr(settings, "GCLOUDC_RPC_QUEUE_SIZE", DEFAULT_QUEUE_SIZE),
+            )
+        return _executor
+
+
+def shutdown_executor(wait=True):
+    """
+        Shuts down the process-wide executor, the next call to get_executor()
+        creates a new one (picking up any change to the settings)
+    """
+    global _executor
+
+    with _lock:
+        executor, _executor = _executor, None
+
+    if executor:
+        executor.shutdown(wait=wait)
+
+
+def executor_metrics():
+    return get_executor().metrics()
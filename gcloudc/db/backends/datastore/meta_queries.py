@@ -1,14 +1,21 @@
 import copy
-import threading
+import heapq
+from collections import OrderedDict
 from functools import cmp_to_key, partial
-from itertools import groupby
+from itertools import chain, groupby
 
 from django.conf import settings
+from django.db import NotSupportedError
 from google.cloud.datastore.key import Key
 
 from . import POLYMODEL_CLASS_ATTRIBUTE, caching
+from .executor import get_executor
 from .query_utils import compare_keys, get_filter, is_keys_only
-from .utils import django_ordering_comparison, entity_matches_query
+from .utils import any_predicate, compile_query_predicate, django_ordering_comparison
+
+
+# The most keys the datastore allows in a single Get
+MAX_KEYS_PER_GET = 1000
 
 
 class AsyncMultiQuery(object):
@@ -17,16 +24,24 @@ class AsyncMultiQuery(object):
         shared ordering.
     """
 
-    # Testing seems to show that more threads == better, but I'm concerned if we
-    # raise this too high we'll start hitting bottlenecks elsewhere. Serious performance
-    # testing needs to happen. Theoretically I think we could make THREAD_COUNT == len(queries)
-    # but I'd rather prove that doesn't cause problems before I do it!
-    THREAD_COUNT = 8
+    def __init__(self, queries, orderings, using="default"):
+        # Imported here for potential circular import and isolation reasons
+        from .dnf import DEFAULT_MAX_ALLOWABLE_QUERIES
 
-    def __init__(self, queries, orderings):
         self._queries = [copy.copy(x) for x in queries]
         self._orderings = orderings
-        self._min_max_cache = {}
+        self._using = using
+
+        # Queries with more branches than this are run in waves of this many
+        self._wave_size = getattr(settings, "DJANGAE_MAX_QUERY_BRANCHES", DEFAULT_MAX_ALLOWABLE_QUERIES)
+
+        # Merging in order needs the next result of every branch, so ordered queries
+        # can't be run in waves and have a page of every branch open at once
+        if orderings and len(self._queries) > self._wave_size:
+            raise NotSupportedError(
+                "Unable to run ordered query as it required more than {} subqueries (limit is configurable "
+                "with DJANGAE_MAX_QUERY_BRANCHES)".format(self._wave_size)
+            )
 
         # When set, this is called on the query before .Run() is called
         # Which allows you to manipulate the options. Recommend this is set/unset
@@ -39,187 +54,178 @@ class AsyncMultiQuery(object):
         for query in self._queries:
             query.keys_only()
 
-    def _spawn_thread(self, i, query, result_queues, **query_run_args):
+    def _get_executor(self):
         """
-            Spawns a thread to return a queries resultset
-
-            *Note* by evaluating the entire query results in the thread we ruin the datastore
-            query batching in the situation that you:
-
-             a. Have limited the query
-             b. Have a large number of results in one or more branches of the OR
+            Returns the executor to fetch the pages on, or None if they have to be
+            fetched on this thread. Transactions are tied to the thread, so inside
+            one the queries must run here to be part of it.
+        """
+        from gcloudc.db.backends.datastore import transaction
 
-            Basically, if you do this:
+        if transaction.in_atomic_block(using=self._using):
+            return None
 
-            MyModel.objects.filter(field1__in=("A", "B"))[:1000]
+        return get_executor()
 
-            and you have 1000 results with "A" and 1000 results with "B" all
-            2000 results will be fetched even though you asked for 1000. However, this is
-            not the most likely situation for a MultiQuery when normally few results will be returned
-            by each branch. Threading seems to help in the common case but we can revisit
-            when we have more data. If threading isn't worth the cost we can revert to just using
-            async queries like Google's multiquery does.
+    def _fetch_page(self, pages):
+        """
+            Fetches the next page of a branch's results, returning None once
+            there are no more pages. This is what runs on the executor threads
+            (or on this thread, when there is no executor).
         """
+        page = next(pages, None)
+        if page is None:
+            return None
 
-        keys_only = self._keys_only
+        return [x.key if self._keys_only else x for x in page]
 
-        class Thread(threading.Thread):
-            def __init__(self, query, *args, **kwargs):
-                self.query = query
-                self.results_fetched = False
-                super(Thread, self).__init__(*args, **kwargs)
+    def _iter_branch(self, executor, pages, future):
+        """
+            Yields the results of a single branch, a page at a time. The next page
+            is only requested once the merge has consumed the current one, so
+            at most one page per branch is held in memory or in flight.
+        """
+        while True:
+            page = self._fetch_page(pages) if executor is None else future.result()
+            if page is None:
+                return
 
-            def run(self):
-                # Evaluate the result set in the thread, but return an iterator
-                # so we can change this if necessary without breaking assumptions elsewhere
-                result_queues[i] = (x.key if keys_only else x for x in self.query.fetch(**query_run_args))
-                self.results_fetched = True
+            for result in page:
+                yield result
 
-        if self._query_decorator:
-            query = self._query_decorator(query)
+            if executor is not None:
+                future = executor.submit(self._fetch_page, pages)
 
-        thread = Thread(query)
-        thread.start()
-        return thread
+    def _waves(self):
+        for i in range(0, len(self._queries), self._wave_size):
+            yield self._queries[i:i + self._wave_size]
 
-    def _fetch_results(self, limit=None):
+    def _fetch_results(self, executor, limit=None, queries=None):
         """
             Returns a list of generators (one for each query in the multi query)
             which generate entity results (or keys if it's keys_only)
 
-            Uses multiple threads to submit RPC calls
-        """
-
-        threads = []
+            The first page of every branch is requested straight away, using the
+            shared executor's threads to run the RPCs concurrently. After that each branch
+            fetches its following pages as the merge reaches them, so a query like:
 
-        # We need to grab a set of results per query
-        result_queues = [None] * len(self._queries)
+            MyModel.objects.filter(field1__in=("A", "B"))[:1000]
 
-        # Go through the queries, trigger new threads as they become available
-        for i, query in enumerate(self._queries):
+            won't download 1000 results from a branch the merge never gets to.
 
-            # Iterate while we have a full thread list
-            while len(threads) >= self.THREAD_COUNT:
-                try:
-                    complete = next(x for x in threads if x.results_fetched)
-                except StopIteration:
-                    # No threads available, continue waiting
-                    continue
+            Without an executor (i.e. in a transaction) each branch fetches all of
+            its pages on this thread, as the merge reaches them.
+        """
+        queries = self._queries if queries is None else queries
 
-                # Remove the complete thread
-                complete.join()
-                threads.remove(complete)
+        results = []
+        for query in queries:
+            if self._query_decorator:
+                query = self._query_decorator(query)
 
-            # Spawn a new thread
-            threads.append(self._spawn_thread(i, query, result_queues, limit=limit))
+            pages = query.fetch(limit=limit).pages
+            future = None if executor is None else executor.submit(self._fetch_page, pages)
+            results.append(self._iter_branch(executor, pages, future))
 
-        [x.join() for x in threads]  # Wait until all the threads are done
+        return results
 
-        return result_queues
+    def _merged_results(self, executor, limit=None):
+        """
+            Returns an iterator of the results of all the branches, in the shared
+            ordering. The results aren't de-duplicated.
 
-    def _compare_entities(self, lhs, rhs):
-        def cmp(a, b):
-            return (a > b) - (a < b)
+            Only unordered queries, which can finish with one wave before starting the
+            next, have more branches than a single wave.
+        """
+        if len(self._queries) <= self._wave_size:
+            return heapq.merge(*self._fetch_results(executor, limit), key=self._sort_key)
+
+        # Without an ordering the results of one wave don't need to be merged with the
+        # next, so each wave is only run once the previous one has been consumed, and
+        # waves after the limit is reached aren't run at all
+        return chain.from_iterable(
+            heapq.merge(*self._fetch_results(executor, limit, wave), key=self._sort_key)
+            for wave in self._waves()
+        )
+
+    def _sort_key(self, entity):
+        """
+            Returns a tuple which sorts the entity (or key if this is keys_only) in
+            the shared ordering of the queries. This is built once per entity so
+            the merge only has to do cheap tuple comparisons.
+        """
+        if isinstance(entity, Key):
+            return (_key_sort_value(entity),)
 
-        if isinstance(lhs, Key) and isinstance(rhs, Key):
-            return compare_keys(lhs, rhs)
+        values = []
+        for column in self._orderings:
+            descending = column.startswith("-")
+            column = column.lstrip("-")
 
-        def get_extreme_if_list_property(entity_key, column, value, descending):
-            if not isinstance(value, list):
-                return value
+            value = entity.key if column == "__key__" else entity.get(column)
 
-            if (entity_key, column) in self._min_max_cache:
-                return self._min_max_cache[(entity_key, column)]
+            # The datastore sorts list properties by their smallest value when
+            # ascending, and their largest value when descending
+            if isinstance(value, list):
+                value = (max(value) if descending else min(value)) if value else None
 
-            if descending:
-                value = min(value)
+            if value is None:
+                value = (0, None)
+            elif isinstance(value, Key):
+                value = (1, _key_sort_value(value))
             else:
-                value = max(value)
-            self._min_max_cache[(entity_key, column)] = value
+                value = (1, value)
 
-        if not lhs:
-            return cmp(lhs, rhs)
+            values.append(_Descending(value) if descending else value)
 
-        for column in self._orderings:
-            descending = column.startswith("-")
-            column = column.lstrip("-")
+        values.append(_key_sort_value(entity.key))
+        return tuple(values)
 
-            lhs_value = lhs.key if column == "__key__" else lhs[column]
-            rhs_value = rhs.key if column == "__key__" else rhs[column]
+    def count(self, limit=None, offset=None):
+        """
+            Returns the number of distinct results of the branches. Branches can
+            return the same entities, so we can't add up the count of each one,
+            instead we fetch just the keys of each branch and count the distinct ones.
+        """
+        offset = offset or 0
 
-            lhs_value = get_extreme_if_list_property(lhs.key, column, lhs_value, descending)
-            rhs_value = get_extreme_if_list_property(lhs.key, column, rhs_value, descending)
+        # If any branch has (offset + limit) results, so does the merged result set
+        to_fetch = None if limit is None else offset + limit
 
-            if isinstance(lhs_value, Key) and isinstance(rhs_value, Key):
-                result = compare_keys(lhs_value, rhs_value)
-            else:
-                result = cmp(lhs_value, rhs_value)
+        self.keys_only()
 
-            if descending:
-                result = -result
-            if result:
-                return result
+        keys = set()
+        for wave in self._waves():
+            for results in self._fetch_results(self._get_executor(), limit=to_fetch, queries=wave):
+                keys.update(results)
 
-        return compare_keys(lhs.key, rhs.key)
+            if to_fetch is not None and len(keys) >= to_fetch:
+                break
+
+        count = len(keys) if to_fetch is None else min(len(keys), to_fetch)
+        return max(0, count - offset)
 
     def fetch(self, offset=None, limit=None):
         """
             Returns an iterator through the result set.
 
-            This calls _fetch_results which returns a list of iterators,
-            where each is the result of a single query. This function does a
-            zig-zag merge of the entities. It starts by creating a list of the next
-            entry in each resultset, then iteratively picks the next entity and then
-            fills the slot from the counterpart result set until all the slots are None.
+            This calls _merged_results, which lazily merges the results of each
+            query on a heap, so the next entry is only pulled from a result set
+            when its previous one has been returned, and we stop pulling once we've
+            returned offset + limit results. Results are de-duplicated (and the
+            offset and limit applied) across all the branches, including those
+            run in later waves of an unordered query.
         """
-        self._min_max_cache = []
-
         # We have to assume that one branch might return all the results and as
         # offsetting is done by skipping results we need to get offset + limit results
         # from each branch
-        results = self._fetch_results(limit=(offset or 0) + limit if limit is not None else None)
-
-        # Go through each outstanding result queue and store
-        # the next entry of each (None if the result queue is done)
-        next_entries = [None] * len(results)
-        for i, queue in enumerate(results):
-            try:
-                next_entries[i] = next(results[i])
-            except StopIteration:
-                next_entries[i] = None
+        results = self._merged_results(self._get_executor(), limit=(offset or 0) + limit if limit is not None else None)
 
         returned_count = 0
         yielded_count = 0
 
         seen_keys = set()  # For de-duping results
-        while any(next_entries):
-
-            def get_next():
-                idx, lowest = None, None
-
-                for i, entry in enumerate(next_entries):
-                    if entry is None:
-                        continue
-
-                    if lowest is None or self._compare_entities(entry, lowest) < 0:
-                        idx, lowest = i, entry
-
-                # Move the queue along if we found the entry there
-                if lowest is not None:
-                    try:
-                        next_entries[idx] = next(results[idx])
-                    except StopIteration:
-                        next_entries[idx] = None
-
-                return lowest
-
-            # Find the next entry from the available queues
-            next_entity = get_next()
-
-            # No more entries if this is the case
-            if next_entity is None:
-                break
-
+        for next_entity in results:
             next_key = next_entity if isinstance(next_entity, Key) else next_entity.key
 
             # Make sure we haven't seen this result before before yielding
@@ -239,6 +245,33 @@ class AsyncMultiQuery(object):
                     break
 
 
+class _Descending(object):
+    """
+        Wraps a value so that it sorts in reverse order
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _key_sort_value(key):
+    """
+        Returns a tuple which sorts keys in the same way as compare_keys, except that
+        integer ids are sorted before names rather than failing to compare
+    """
+    return (key.project, key.namespace or "") + tuple(
+        (0, x, "") if isinstance(x, int) else (1, 0, x) for x in key.flat_path
+    )
+
+
 def _convert_entity_based_on_query_options(entity, keys_only, projection):
     if keys_only:
         return entity.key
@@ -261,10 +294,7 @@ DEFAULT_MAX_ENTITY_COUNT = 8
 class QueryByKeys(object):
     """ Does the most efficient fetching possible for when we have the keys of the entities we want. """
 
-    def __init__(self, connection, model, queries, ordering, namespace):
-        # Imported here for potential circular import and isolation reasons
-        from .dnf import DEFAULT_MAX_ALLOWABLE_QUERIES
-
+    def __init__(self, using, model, queries, ordering, namespace):
         # `queries` should be filtered by __key__ with keys that have the namespace applied to them.
         # `namespace` is passed for explicit niceness (mostly so that we don't have to assume that
         # all the keys belong to the same namespace, even though they will).
@@ -275,14 +305,39 @@ class QueryByKeys(object):
         def compare_queries(lhs, rhs):
             return compare_keys(_get_key(lhs), _get_key(rhs))
 
-        self.connection = connection
+        # groupby requires that the iterable is sorted by the given key before grouping
+        queries = sorted(queries, key=cmp_to_key(compare_queries))
+        queries_by_key = {a: list(b) for a, b in groupby(queries, _get_key)}
+
+        self._setup(using, model, queries, queries_by_key, len(queries), ordering, namespace)
+
+    @classmethod
+    def from_keys(cls, using, model, keys, query, ordering, namespace):
+        """
+            Builds a QueryByKeys from a list of keys, and a single query holding the
+            other filters which each entity must match. This avoids building (and
+            sorting) a query for each key when there are lots of them.
+        """
+        self = cls.__new__(cls)
+
+        queries = [query]
+        queries_by_key = OrderedDict((key, queries) for key in keys)
+
+        self._setup(using, model, queries, queries_by_key, len(keys), ordering, namespace)
+        return self
+
+    def _setup(self, using, model, queries, queries_by_key, query_count, ordering, namespace):
+        # Imported here for potential circular import and isolation reasons
+        from .dnf import DEFAULT_MAX_ALLOWABLE_QUERIES
+
+        # The alias of the connection
+        self.using = using
         self.model = model
         self.namespace = namespace
 
-        # groupby requires that the iterable is sorted by the given key before grouping
-        self.queries = sorted(queries, key=cmp_to_key(compare_queries))
-        self.query_count = len(self.queries)
-        self.queries_by_key = {a: list(b) for a, b in groupby(self.queries, _get_key)}
+        self.queries = queries
+        self.query_count = query_count
+        self.queries_by_key = queries_by_key
 
         self.max_allowable_queries = getattr(settings, "DJANGAE_MAX_QUERY_BRANCHES", DEFAULT_MAX_ALLOWABLE_QUERIES)
         self.can_multi_query = self.query_count < self.max_allowable_queries
@@ -294,38 +349,94 @@ class QueryByKeys(object):
     def keys_only(self):
         self._keys_only_override = True
 
+    def _matcher(self):
+        """
+            Returns a function which checks whether an entity matches any of the
+            queries for its key. Each list of queries is only compiled once, which
+            matters when they're shared by lots of keys.
+        """
+        compiled = {}
+        predicates = {}
+        for key, queries in self.queries_by_key.items():
+            if id(queries) not in compiled:
+                compiled[id(queries)] = any_predicate([compile_query_predicate(x) for x in queries])
+            predicates[key] = compiled[id(queries)]
+
+        return lambda entity: predicates[entity.key](entity)
+
+    def _get(self, keys):
+        """
+            Gets the entities for the keys with a datastore Get. The datastore only
+            allows MAX_KEYS_PER_GET keys per Get, so larger lists are split up and
+            (outside of transactions, which are tied to the thread) sent concurrently.
+        """
+        from gcloudc.db.backends.datastore import transaction
+
+        client = transaction._rpc(self.using)
+
+        batches = [keys[i:i + MAX_KEYS_PER_GET] for i in range(0, len(keys), MAX_KEYS_PER_GET)]
+        if len(batches) == 1 or transaction.in_atomic_block(using=self.using):
+            return list(chain.from_iterable(client.get(batch) for batch in batches))
+
+        executor = get_executor()
+        futures = [executor.submit(client.get, batch) for batch in batches]
+        return list(chain.from_iterable(future.result() for future in futures))
+
+    def count(self, limit=None, offset=None):
+        """
+            Counts the entities which exist and match their queries. Unlike fetch
+            there's no need to run projection queries, sort or convert the results.
+        """
+        keys = list(self.queries_by_key)
+
+        cached = caching.get_from_cache_by_keys(keys, using=self.using)
+        missing = [key for key in keys if key not in cached]
+
+        results = list(cached.values())
+        if missing:
+            results.extend(self._get(missing))
+
+        matches = self._matcher()
+        count = len([result for result in results if result is not None and matches(result)])
+
+        offset = offset or 0
+        if limit is not None:
+            count = min(count, offset + limit)
+
+        return max(0, count - offset)
+
     def fetch(self, limit=None, offset=None):
         """
             Here are the options:
 
-            1. Single key, hit memcache
+            1. Take whatever we can from the cache
             2. Multikey projection, async MultiQueries with ancestors chained
-            3. Full select, datastore get
+            3. Full select, datastore get of the keys the cache didn't have
         """
         from gcloudc.db.backends.datastore import transaction
         from gcloudc.db.backends.datastore.caching import MAX_CACHE_COUNT
 
         base_query = self.queries[0]
-        key_count = len(self.queries_by_key)
+        keys = list(self.queries_by_key)
+        assert(all(isinstance(key, Key) for key in keys))
 
         is_projection = False
 
-        cache_results = True
-        results = None
+        # Taken before reading anything, so entities written in the meantime aren't cached
+        read_generation = caching.shared_cache_generation(self.model, using=self.using)
 
-        if key_count == 1:
-            # FIXME: Potentially could use get_multi in memcache and the make a query
-            # for whatever remains
-            key = next(iter(self.queries_by_key))
-            assert(isinstance(key, Key))
+        cached = caching.get_from_cache_by_keys(keys, using=self.using)
+        missing = [key for key in keys if key not in cached]
 
-            result = caching.get_from_cache_by_key(key)
-            if result is not None:
-                results = [result]
-                cache_results = False  # Don't update cache, we just got it from there
+        # Only the entities we fetched need adding to the cache, the rest we just got from there
+        to_cache = []
 
-        client = transaction._rpc(self.connection)
-        if results is None:
+        client = transaction._rpc(self.using)
+        if not missing:
+            results = [cached[key] for key in keys]
+        else:
+            # Projections are answered by the ancestor queries below as a whole, there's
+            # no merging full entities with them, so only a complete cache hit avoids them
             if base_query.projection and self.can_multi_query:
                 is_projection = True
 
@@ -355,37 +466,47 @@ class QueryByKeys(object):
                                 namespace=self.namespace,
                             )
 
+                        else:
+                            # The query can be shared between keys
+                            query = copy.copy(query)
+
                         query.ancestor = key  # Make this an ancestor query
                         multi_query.append(query)
 
                 if len(multi_query) == 1:
                     results = multi_query[0].fetch(limit=to_fetch)
                 else:
-                    results = AsyncMultiQuery(multi_query, orderings).fetch(limit=to_fetch)
+                    results = AsyncMultiQuery(multi_query, orderings, using=self.using).fetch(limit=to_fetch)
             else:
-                results = client.get([x for x in self.queries_by_key.keys()])
+                to_cache = [x for x in self._get(missing) if x is not None]
+
+                # Merge the fetched entities back in with the cached ones, in the order of the keys
+                fetched = {x.key: x for x in to_cache}
+                results = [cached[key] if key in cached else fetched.get(key) for key in keys]
 
         def iter_results(results):
             returned = 0
             # This is safe, because Django is fetching all results any way :(
-            sorted_results = sorted(results, key=cmp_to_key(partial(django_ordering_comparison, self.ordering)))
+            if self.ordering:
+                sorted_results = sorted(results, key=cmp_to_key(partial(django_ordering_comparison, self.ordering)))
+            else:
+                # Keep the order the keys were asked for in
+                sorted_results = results
             sorted_results = [result for result in sorted_results if result is not None]
 
-            if cache_results and sorted_results:
+            if to_cache:
                 caching.add_entities_to_cache(
                     self.model,
-                    sorted_results[:MAX_CACHE_COUNT],
+                    to_cache[:MAX_CACHE_COUNT],
                     caching.CachingSituation.DATASTORE_GET,
                     self.namespace,
+                    read_generation=read_generation,
                 )
 
-            for result in sorted_results:
-                if is_projection:
-                    matches_query = True
-                else:
-                    matches_query = any(entity_matches_query(result, qry) for qry in self.queries_by_key[result.key])
+            matches = None if is_projection else self._matcher()
 
-                if not matches_query:
+            for result in sorted_results:
+                if matches is not None and not matches(result):
                     continue
 
                 if offset and returned < offset:
@@ -407,6 +528,9 @@ class QueryByKeys(object):
 
 
 class NoOpQuery(object):
+    def count(self, limit, offset):
+        return 0
+
     def fetch(self, limit, offset):
         return []
 
@@ -436,21 +560,29 @@ class UniqueQuery(object):
         if opts.keys_only or opts.projection:
             return self._gae_query.Run(limit=limit, offset=offset)
 
+        matches = compile_query_predicate(self._gae_query)
+
         ret = caching.get_from_cache(self._identifier, self._namespace)
-        if ret is not None and not entity_matches_query(ret, self._gae_query):
+        if ret is not None and not matches(ret):
             ret = None
 
         if ret is None:
+            read_generation = caching.shared_cache_generation(self._model)
+
             # We do a fast keys_only query to get the result
             keys_query = rpc.Query(self.kind, keys_only=True, namespace=self._namespace)
             keys_query.update(self._gae_query)
             keys = keys_query.Run(limit=limit, offset=offset)
 
             # Do a consistent get so we don't cache stale data, and recheck the result matches the query
-            ret = [x for x in rpc.Get(keys) if x and entity_matches_query(x, self._gae_query)]
+            ret = [x for x in rpc.Get(keys) if x and matches(x)]
             if len(ret) == 1:
                 caching.add_entities_to_cache(
-                    self._model, [ret[0]], caching.CachingSituation.DATASTORE_GET, self._namespace
+                    self._model,
+                    [ret[0]],
+                    caching.CachingSituation.DATASTORE_GET,
+                    self._namespace,
+                    read_generation=read_generation,
                 )
             return iter(ret)
 
@@ -0,0 +1,298 @@
+"""
+    Caches the result of preparing and normalizing queries.
+
+    Query.prepare() and normalize_query() (the DNF explosion and the various
+    _remove_* passes) are pure functions of the shape of the where tree: the
+    columns, operators, connectors and negations. With a couple of exceptions
+    they don't care about the values being filtered on, so queries which differ
+    only by their values can share the work.
+
+    To do that we normalize a copy of the where tree where every value has
+    been swapped for a _Parameter placeholder. The result is cached as a plan,
+    keyed on the shape, and executing a query then only means binding its
+    values into the plan. If normalizing looks at a value in a way that
+    matters (comparing two of them, or checking their truthiness) the
+    placeholder raises, and queries of that shape are always normalized the
+    normal way.
+"""
+import copy
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .dnf import (
+    DEFAULT_MAX_ALLOWABLE_QUERIES,
+    DEFAULT_MAX_QUERY_WAVES,
+    normalize_key_lookup,
+    normalize_query,
+)
+from .query import WhereNode, transform_query
+
+# The max number of plans kept, the least recently used are dropped first. Setting
+# GCLOUDC_QUERY_PLAN_CACHE_SIZE to 0 disables the cache
+DEFAULT_PLAN_CACHE_SIZE = 1000
+
+_UNCACHEABLE = object()
+
+_lock = threading.Lock()
+_plans = OrderedDict()
+
+
+class _ValueDependent(Exception):
+    pass
+
+
+class _Parameter(object):
+    """
+        Stands in for a value while normalizing a query. Anything other than
+        passing it around raises _ValueDependent.
+    """
+
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __deepcopy__(self, memo):
+        # The DNF explosion deep copies branches, the copies must still refer to
+        # the same parameter
+        return self
+
+    def _value_dependent(self, *args):
+        raise _ValueDependent()
+
+    __lt__ = __le__ = __gt__ = __ge__ = __ne__ = __bool__ = __len__ = _value_dependent
+
+    def __repr__(self):
+        return "<Parameter {}>".format(self.index)
+
+
+class QueryPlan(object):
+    def __init__(self, query):
+        self.where = query.where
+        self.excluded_pks = list(query.excluded_pks)
+        self.columns = None if query.columns is None else frozenset(query.columns)
+        self.projection_possible = query.projection_possible
+        self.init_list = list(query.init_list)
+        self.polymodel_filter_added = query.polymodel_filter_added
+
+    def bind(self, query, params):
+        """
+            Applies the plan to a transformed (but not prepared) query with
+            the given parameter values, this does what prepare() and
+            normalize_query() would have done
+        """
+        query.where = _bind_node(self.where, params) if self.where else None
+        if query.where:
+            # Normalizing drops duplicate branches, which depends on the values
+            query.where.children = _remove_duplicates(query.where.children)
+        query.excluded_pks = set(_bind_value(x, params) for x in self.excluded_pks)
+        query.columns = None if self.columns is None else set(self.columns)
+        query.projection_possible = self.projection_possible
+        query.init_list = list(self.init_list)
+        query.polymodel_filter_added = self.polymodel_filter_added
+        return query
+
+
+def _is_sequence(value):
+    return isinstance(value, (list, tuple))
+
+
+def _value_shape(node):
+    # ISNULL values decide what the node turns into, so they are part of the shape
+    if node.operator == "ISNULL":
+        return ("literal", node.value)
+
+    if _is_sequence(node.value):
+        if any(_is_sequence(x) for x in node.value):
+            return None
+        return (type(node.value), len(node.value))
+
+    return "param"
+
+
+def _shape(node, params):
+    """
+        Returns a hashable description of the where tree, without its values,
+        and appends the values to params in the order they were reached.
+        Returns None if the tree can't be described.
+    """
+    if node.is_leaf:
+        value_shape = _value_shape(node)
+        if value_shape is None:
+            return None
+
+        if value_shape == "param":
+            params.append(node.value)
+        elif value_shape[0] != "literal":
+            params.extend(node.value)
+
+        return (
+            node.column, node.operator, node.lookup_name, node.negated,
+            node.will_never_return_results, value_shape
+        )
+
+    children = []
+    for child in node.children:
+        child_shape = _shape(child, params)
+        if child_shape is None:
+            return None
+        children.append(child_shape)
+
+    return (node.connector, node.negated, node.will_never_return_results, tuple(children))
+
+
+def _copy_node(node, value):
+    new_node = WhereNode(node.using)
+    new_node.column = node.column
+    new_node.operator = node.operator
+    new_node.value = value
+    new_node.output_field = node.output_field
+    new_node.will_never_return_results = node.will_never_return_results
+    new_node.lookup_name = node.lookup_name
+    new_node.connector = node.connector
+    new_node.negated = node.negated
+    return new_node
+
+
+def _parameterize(node, params):
+    """
+        Returns a copy of the where tree with its values replaced by parameters,
+        numbered in the same order as _shape() collects them
+    """
+    if node.is_leaf:
+        value = node.value
+        if _value_shape(node) == "param":
+            value = _Parameter(len(params))
+            params.append(value)
+        elif _is_sequence(value) and node.operator != "ISNULL":
+            parameters = []
+            for _ in value:
+                parameters.append(_Parameter(len(params)))
+                params.append(parameters[-1])
+            value = type(value)(parameters)
+
+        return _copy_node(node, value)
+
+    new_node = _copy_node(node, None)
+    new_node.children = [_parameterize(child, params) for child in node.children]
+    return new_node
+
+
+def _remove_duplicates(nodes):
+    try:
+        return list(OrderedDict.fromkeys(nodes))
+    except TypeError:
+        # Unhashable values, duplicate branches are harmless other than
+        # running the same query twice
+        return nodes
+
+
+def _bind_value(value, params):
+    if isinstance(value, _Parameter):
+        return params[value.index]
+    elif _is_sequence(value):
+        return type(value)(_bind_value(x, params) for x in value)
+    return value
+
+
+def _bind_node(node, params):
+    new_node = _copy_node(node, _bind_value(node.value, params))
+    new_node.children = [_bind_node(child, params) for child in node.children]
+    return new_node
+
+
+def _compile(query):
+    """
+        Prepares and normalizes the query with its values replaced by parameters,
+        returns the plan or _UNCACHEABLE if normalizing depended on the values
+    """
+    # Preparing replaces (rather than mutates) the attributes it changes, other
+    # than the where, so a shallow copy leaves the original query untouched
+    query = copy.copy(query)
+    query.where = _parameterize(query.where, []) if query.where else None
+
+    try:
+        query.prepare()
+        query = normalize_query(query)
+    except Exception:
+        # Either _ValueDependent, or an error which the real values might not
+        # raise (e.g. EmptyResultSet) so we leave those to the normal path
+        return _UNCACHEABLE
+
+    return QueryPlan(query)
+
+
+def _cache_key(connection, query, shape):
+    return (
+        connection.alias,
+        query.model,
+        query.kind,
+        None if query.columns is None else frozenset(query.columns),
+        tuple(query.init_list),
+        query.projection_possible,
+        query.polymodel_filter_added,
+        getattr(settings, "DJANGAE_MAX_QUERY_BRANCHES", DEFAULT_MAX_ALLOWABLE_QUERIES),
+        getattr(settings, "GCLOUDC_MAX_QUERY_WAVES", DEFAULT_MAX_QUERY_WAVES),
+        shape,
+    )
+
+
+def _normalize(query):
+    query.prepare()
+    return normalize_query(query)
+
+
+def _has_key_list(node):
+    if node.is_leaf:
+        return node.column == "__key__" and node.operator == "IN"
+    return any(_has_key_list(child) for child in node.children)
+
+
+def get_normalized_query(connection, django_query):
+    """
+        Transforms the Django query and returns it prepared and normalized,
+        reusing the plan for queries of the same shape where possible
+    """
+    query = transform_query(connection, django_query)
+
+    # Lookups of lists of keys are normalized without exploding them, and there's
+    # no point in a plan as the number of keys is part of the shape
+    if query.where and _has_key_list(query.where):
+        query.prepare()
+        return normalize_key_lookup(query) or normalize_query(query)
+
+    max_size = getattr(settings, "GCLOUDC_QUERY_PLAN_CACHE_SIZE", DEFAULT_PLAN_CACHE_SIZE)
+    if not max_size:
+        return _normalize(query)
+
+    params = []
+    shape = _shape(query.where, params) if query.where else ()
+    if shape is None:
+        return _normalize(query)
+
+    key = _cache_key(connection, query, shape)
+
+    with _lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+
+    if plan is None:
+        plan = _compile(query)
+
+        with _lock:
+            _plans[key] = plan
+            while len(_plans) > max_size:
+                _plans.popitem(last=False)
+
+    if plan is _UNCACHEABLE:
+        return _normalize(query)
+
+    return plan.bind(query, params)
+
+
+def clear_query_plan_cache():
+    with _lock:
+        _plans.clear()
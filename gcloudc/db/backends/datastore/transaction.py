@@ -1,6 +1,7 @@
-import threading
-import uuid
 import copy
+import random
+import threading
+import time
 
 from django.db import connections
 from gcloudc import context_decorator
@@ -9,11 +10,21 @@ from google.cloud import exceptions
 from google.cloud.datastore.transaction import \
     Transaction as DatastoreTransaction
 
+# The most entities which can be written in a single transaction (or batch). This can
+# be lowered for a connection with TRANSACTION_ENTITY_LIMIT in its DATABASES entry
 TRANSACTION_ENTITY_LIMIT = 500
 
 
+def get_entity_limit(using="default"):
+    """
+        Returns the number of entities we write in a single transaction on the
+        given connection
+    """
+    return connections[using].settings_dict.get("TRANSACTION_ENTITY_LIMIT") or TRANSACTION_ENTITY_LIMIT
+
+
 def in_atomic_block(using="default"):
-    txn = current_transaction()
+    txn = current_transaction(using)
     if not txn:
         return False
 
@@ -26,24 +37,20 @@ def in_atomic_block(using="default"):
 
 
 class Transaction(object):
-    def __init__(self, connection, datastore_transaction=None):
+    def __init__(self, connection, datastore_transaction=None, read_only=False):
         self._connection = connection
         self._datastore_transaction = datastore_transaction
+        self.read_only = read_only
         self._seen_keys = set()
+        self._written_keys = set()
 
-    def _generate_id(self):
+    def allocate_ids(self, incomplete_key, num_ids):
         """
             The Datastore API won't generate keys automatically until a
-            transaction commits, that's too late!
-
-            This is a hack, it might be the only hack we can do :(
-
-            Note. Even though the Datastore can handle negative IDs (it's a signed
-            64 bit integer) the default allocate never does, and also, this breaks
-            Django URL regexes etc. So like the allocator we just do 32 bit ones.
+            transaction commits, that's too late! So we ask the Datastore to
+            allocate the ids up-front, all num_ids of them in a single RPC.
         """
-        unsigned = uuid.uuid4().int & (1 << 32) - 1
-        return unsigned
+        return self._connection.gclient.allocate_ids(incomplete_key, num_ids)
 
     def key(self, *args, **kwargs):
         """
@@ -76,10 +83,29 @@ class Transaction(object):
         return ret
 
     def put_multi(self, entities):
+        """
+            Puts all the entities. Inside a transaction the writes are buffered
+            until commit, outside of one they are sent with a single RPC.
+        """
+        self._check_writable()
+
+        if self._datastore_transaction:
+            return [self.put(entity) for entity in entities]
+
+        self._connection.gclient.put_multi(entities)
+
+        keys = []
         for entity in entities:
-            self.put(entity)
+            assert entity.key
+            self._seen_keys.add(entity.key)
+            keys.append(entity.key)
+
+        self._record_writes(keys)
+        return keys
 
     def put(self, entity):
+        self._check_writable()
+
         putter = self._datastore_transaction.put if self._datastore_transaction else self._connection.gclient.put
 
         putter(entity)
@@ -87,6 +113,7 @@ class Transaction(object):
         assert entity.key
 
         self._seen_keys.add(entity.key)
+        self._record_writes([entity.key])
 
         return entity.key
 
@@ -95,8 +122,12 @@ class Transaction(object):
         Delete an entity or entities using a different API depending if we
         are currently in a transaction batch or not.
         """
+        self._check_writable()
+
         # if we've got an iterable of keys....
         if hasattr(key_or_keys, "__iter__"):
+            key_or_keys = list(key_or_keys)
+
             # there is no delete_multi on the transaction object directly
             if self._datastore_transaction:
                 for key in key_or_keys:
@@ -110,16 +141,35 @@ class Transaction(object):
                 # delete() is just a wrapper around delete_multi anyway...
                 self._connection.gclient.delete_multi([key_or_keys])
 
+        self._record_writes(key_or_keys if hasattr(key_or_keys, "__iter__") else [key_or_keys])
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ReadOnlyTransactionError("Entities can't be put or deleted inside a read-only transaction")
+
+    def _record_writes(self, keys):
+        """
+            Writes made outside a transaction (or batch) have already happened, so
+            we drop the entities from the process-wide cache straight away. Otherwise
+            we wait until the transaction has been committed.
+        """
+        if self._datastore_transaction:
+            self._written_keys.update(keys)
+        else:
+            caching.remove_entities_from_shared_cache(keys)
+
     def query(self, *args, **kwargs):
         return self._connection.gclient.query(*args, **kwargs)
 
     def enter(self):
         self._seen_keys = set()
+        self._written_keys = set()
         self._enter()
 
     def exit(self):
         self._exit()
         self._seen_keys = set()
+        self._written_keys = set()
 
     def _enter(self):
         raise NotImplementedError()
@@ -181,9 +231,9 @@ class Transaction(object):
 
 
 class IndependentTransaction(Transaction):
-    def __init__(self, connection):
-        txn = connection.gclient.transaction()
-        super().__init__(connection, txn)
+    def __init__(self, connection, read_only=False):
+        txn = connection.gclient.transaction(read_only=read_only)
+        super().__init__(connection, txn, read_only=read_only)
 
     def _enter(self):
         self._datastore_transaction.begin()
@@ -201,9 +251,9 @@ class NestedTransaction(Transaction):
 
 
 class NormalTransaction(Transaction):
-    def __init__(self, connection):
-        txn = connection.gclient.transaction()
-        super().__init__(connection, txn)
+    def __init__(self, connection, read_only=False):
+        txn = connection.gclient.transaction(read_only=read_only)
+        super().__init__(connection, txn, read_only=read_only)
 
     def _enter(self):
         self._datastore_transaction.begin()
@@ -285,6 +335,95 @@ class TransactionFailedError(Exception):
     pass
 
 
+class ReadOnlyTransactionError(Exception):
+    """
+        Raised when something tries to put or delete an entity inside an
+        atomic(read_only=True) block
+    """
+    pass
+
+
+class TransactionConflictError(TransactionFailedError):
+    """
+        Raised when a transaction couldn't be committed because of contention with
+        other transactions, trying it again may well work
+    """
+    pass
+
+
+# When atomic() is given retries, the first retry waits for up to this many seconds
+# (unless a backoff is passed) and each one after that up to twice as long as the
+# one before, but never longer than MAX_RETRY_BACKOFF
+DEFAULT_RETRY_BACKOFF = 0.1
+MAX_RETRY_BACKOFF = 5.0
+
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+def _record_metrics(call_site, attempts=0, conflicts=0, commit_time=None):
+    with _metrics_lock:
+        metrics = _metrics.setdefault(
+            call_site, {"attempts": 0, "conflicts": 0, "commits": 0, "commit_time": 0.0, "max_commit_time": 0.0}
+        )
+        metrics["attempts"] += attempts
+        metrics["conflicts"] += conflicts
+
+        if commit_time is not None:
+            metrics["commits"] += 1
+            metrics["commit_time"] += commit_time
+            metrics["max_commit_time"] = max(metrics["max_commit_time"], commit_time)
+
+
+def transaction_metrics():
+    """
+        Returns the counters of each function decorated with atomic(), keyed by
+        the function's dotted path: the number of attempts at running it, how many
+        of those conflicted with another transaction, and how many commits succeeded
+        and how long (in seconds) those took in total and at most
+    """
+    with _metrics_lock:
+        return {call_site: dict(metrics) for call_site, metrics in _metrics.items()}
+
+
+def reset_transaction_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+
+def _call_with_retries(call, func, decorator_args, args, kwargs):
+    """
+        Calls the decorated function with `call`, calling it again (up to `retries`
+        times) if the transaction conflicts with another one. Each retry waits for
+        a random time, of up to twice as long as the one before.
+    """
+    retries = decorator_args.get("retries") or 0
+    backoff = decorator_args.get("backoff") or DEFAULT_RETRY_BACKOFF
+    independent = decorator_args.get("independent")
+
+    # Only the outermost transaction commits, so re-running a nested one wouldn't
+    # help, the conflict is raised (and can be retried) from the outer one
+    if in_atomic_block(decorator_args.get("using") or "default") and not independent:
+        retries = 0
+
+    call_site = "{}.{}".format(func.__module__, getattr(func, "__qualname__", func.__name__))
+    decorator_args["call_site"] = call_site
+
+    attempt = 0
+    while True:
+        _record_metrics(call_site, attempts=1)
+        try:
+            # Each attempt gets its own copy, as entering the transaction changes them
+            return call(dict(decorator_args), args, kwargs)
+        except (TransactionConflictError, exceptions.Conflict):
+            _record_metrics(call_site, conflicts=1)
+            if attempt >= retries:
+                raise
+
+        time.sleep(random.uniform(0, min(backoff * (2 ** attempt), MAX_RETRY_BACKOFF)))
+        attempt += 1
+
+
 class AtomicDecorator(context_decorator.ContextDecorator):
     """
     Exposes a decorator based API for transaction use. This in turn allows us
@@ -293,9 +432,24 @@ class AtomicDecorator(context_decorator.ContextDecorator):
     For example passing `independent` creates a new transaction instance using
     the Datastore client under the hood. This is useful to workaround the
     limitations of 500 entity writes per transaction/batch.
+
+    Passing `read_only` starts a read-only transaction, which reads from a
+    consistent snapshot without taking any locks, so it doesn't contend with
+    writers. Putting or deleting anything inside it raises ReadOnlyTransactionError.
+    Like the other arguments, it only applies to the outermost (or an independent)
+    transaction, nested blocks are part of the transaction they're nested in.
+
+    When decorating a function, passing `retries` calls the function again (up to
+    that many times) if the transaction conflicts with another one, after a random
+    delay of up to `backoff` seconds, doubling for each retry.
     """
 
-    VALID_ARGUMENTS = ("independent", "mandatory", "using", "read_only", "enable_cache")
+    VALID_ARGUMENTS = (
+        "independent", "mandatory", "using", "read_only", "enable_cache", "retries", "backoff"
+    )
+
+    def _call_decorated(self, decorator_args, args, kwargs):
+        return _call_with_retries(super()._call_decorated, self.func, decorator_args, args, kwargs)
 
     @classmethod
     def _do_enter(cls, state, decorator_args):
@@ -310,6 +464,10 @@ class AtomicDecorator(context_decorator.ContextDecorator):
         independent = False if independent is None else independent
         read_only = False if read_only is None else read_only
         state.using = using = "default" if using is None else using
+        state.call_site = decorator_args.get("call_site")
+
+        if decorator_args.get("retries") and not state.call_site:
+            raise ValueError("retries can only be used when atomic() decorates a function, a block can't be re-run")
 
         # FIXME: Implement context caching for transactions
         enable_cache = decorator_args.get("enable_cache", True)
@@ -326,15 +484,15 @@ class AtomicDecorator(context_decorator.ContextDecorator):
         assert(connection)
 
         if independent:
-            new_transaction = IndependentTransaction(connection)
-        elif in_atomic_block():
+            new_transaction = IndependentTransaction(connection, read_only=read_only)
+        elif in_atomic_block(using):
             new_transaction = NestedTransaction(connection)
         elif mandatory:
             raise TransactionFailedError(
                 "You've specified that an outer transaction is mandatory, but one doesn't exist"
             )
         else:
-            new_transaction = NormalTransaction(connection)
+            new_transaction = NormalTransaction(connection, read_only=read_only)
 
         _STORAGE.transaction_stack.setdefault(using, []).append(new_transaction)
         _STORAGE.transaction_stack[using][-1].enter()
@@ -358,10 +516,21 @@ class AtomicDecorator(context_decorator.ContextDecorator):
                 if exception:
                     transaction._datastore_transaction.rollback()
                 else:
+                    start = time.time()
                     try:
                         transaction._datastore_transaction.commit()
+                    except exceptions.Conflict:
+                        # Nothing was written, so nothing staged in the context cache should be kept
+                        exception = True
+                        raise TransactionConflictError()
                     except exceptions.GoogleCloudError:
+                        exception = True
                         raise TransactionFailedError()
+
+                    if state.call_site:
+                        _record_metrics(state.call_site, commit_time=time.time() - start)
+
+                    caching.remove_entities_from_shared_cache(transaction._written_keys)
         finally:
             if isinstance(transaction, (IndependentTransaction, NormalTransaction)):
                 context = caching.get_context()
@@ -382,6 +551,9 @@ commit_on_success = AtomicDecorator  # Alias to the old Django name for this kin
 class NonAtomicDecorator(AtomicDecorator):
     VALID_ARGUMENTS = ("using",)
 
+    # There's no transaction to conflict, so nothing to retry
+    _call_decorated = context_decorator.ContextDecorator._call_decorated
+
     @classmethod
     def _do_enter(cls, state, decorator_args):
         _init_storage()
@@ -430,6 +602,8 @@ class NonAtomicDecorator(AtomicDecorator):
                         transaction._datastore_transaction.commit()
                     except exceptions.GoogleAPIError:
                         raise TransactionFailedError()
+
+                    caching.remove_entities_from_shared_cache(transaction._written_keys)
         finally:
             # Restore the context stack as it was
             context.stack.stack = context.stack.stack + state.original_stack
@@ -1,18 +1,20 @@
+import operator
 from datetime import datetime
 from decimal import Decimal
-from itertools import chain
+from functools import partial
 
 from django.apps import apps
 from django.conf import settings
 from django.db import IntegrityError
 from django.db.backends.utils import format_number
 from django.utils import timezone
+from django.utils.module_loading import import_string
 from google.cloud.datastore.entity import Entity
 from google.cloud.datastore.key import Key
+from google.cloud.datastore_v1.proto import query_pb2
 
 from gcloudc.utils import memoized
 
-from .query_utils import get_filter
 
 try:
     from django.db.models.expressions import BaseExpression
@@ -318,6 +320,19 @@ def key_exists(connection, key):
     return count_query(qry) > 0
 
 
+def keys_exist(connection, keys):
+    """
+        Returns the set of `keys` which exist in the Datastore, checking all
+        of them with a single Get rather than a query per key
+    """
+    from . import transaction
+
+    if not keys:
+        return set()
+
+    return set([x.key for x in transaction._rpc(connection).get(keys)])
+
+
 # Null-friendly comparison functions
 
 
@@ -388,64 +403,131 @@ def django_ordering_comparison(ordering, lhs, rhs):
     return 0
 
 
-def entity_matches_query(entity, query):
+def _key_path(key):
+    return tuple([key.namespace] + list(key.flat_path))
+
+
+_KEY_PATH_COMPARISONS = {
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}
+
+_RANGE_COMPARISONS = {
+    "<": lt,
+    ">": gt,
+    "<=": lte,
+    ">=": gte,
+}
+
+
+def _range_comparator(op, value):
+    compare = _RANGE_COMPARISONS[op]
+
+    if isinstance(value, Key):
+        # Work out the path of the query's key once, rather than for every comparison
+        path = _key_path(value)
+        compare_paths = _KEY_PATH_COMPARISONS[op]
+
+        def comparator(x):
+            if isinstance(x, Key):
+                return compare_paths(_key_path(x), path)
+            return compare(x, value)
+
+        return comparator
+
+    return lambda x: compare(x, value)
+
+
+_COMPARATORS = {
+    "=": lambda value: lambda x: x == value,
+    "<": partial(_range_comparator, "<"),
+    ">": partial(_range_comparator, ">"),
+    "<=": partial(_range_comparator, "<="),
+    ">=": partial(_range_comparator, ">="),
+}
+
+
+def _filter_check(column, comparators):
     """
-        Return True if the entity would potentially be returned by the datastore
-        query
+        Returns a function which checks an entity's value for the column against
+        the comparators. An entity with a list value matches a comparator if
+        any of its values do, and it must match all of them.
     """
-    from . import meta_queries
+    if len(comparators) == 1:
+        comparator = comparators[0]
 
-    OPERATORS = {"=": lambda x, y: x == y, "<": lt, ">": gt, "<=": lte, ">=": gte}
+        def check(entity):
+            value = entity.get(column)
+            if isinstance(value, (list, tuple)):
+                return any(comparator(x) for x in value)
+            return comparator(value)
 
-    queries = [query]
-    if isinstance(query, meta_queries.AsyncMultiQuery):
-        raise NotImplementedError(
-            "We just need to separate the multiquery " "into 'queries' then everything should work"
-        )
+        return check
 
-    for query in queries:
-        comparisons = chain([("__kind__", "=")], [(x[0], x[1]) for x in query.filters])
+    def check(entity):
+        values = entity.get(column)
+        if not isinstance(values, (list, tuple)):
+            values = (values,)
+        return all(any(comparator(x) for x in values) for comparator in comparators)
 
-        for ent_attr, op in comparisons:
-            if ent_attr == "__key__":
-                continue
+    return check
 
-            compare = OPERATORS[op]  # We want this to throw if there's some op we don't know about
 
-            if ent_attr == "__kind__":
-                ent_value = entity.kind
-                query_value = query.kind
-            else:
-                query_value = get_filter(query, (ent_attr, op))
-                ent_value = entity.get(ent_attr)
+def any_predicate(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda entity: any(predicate(entity) for predicate in predicates)
 
-            if not isinstance(query_value, (list, tuple)):
-                query_values = [query_value]
-            else:
-                # The query value can be a list of ANDed values
-                query_values = query_value
-
-            if not isinstance(ent_value, (list, tuple)):
-                ent_value = [ent_value]
-
-            matches = False
-            for value in query_values:  # [22, 23]
-                # If any of the values don't match then this query doesn't match
-                if not any(compare(attr, value) for attr in ent_value):
-                    matches = False
-                    break
-            else:
-                # One of the ent_attrs matches the query_attrs
-                matches = True
 
-            if not matches:
-                # One of the AND values didn't match
-                break
+def compile_query_predicate(query):
+    """
+        Returns a function which, given an entity, returns True if the entity would
+        potentially be returned by the datastore query. The query's filters are
+        only looked at once, so this is much cheaper than calling
+        entity_matches_query when checking lots of entities against the same query.
+    """
+    from . import meta_queries
+
+    if isinstance(query, meta_queries.AsyncMultiQuery):
+        return any_predicate([compile_query_predicate(x) for x in query._queries])
+
+    kind = query.kind
+    checks = []
+
+    for column, op, value in query.filters:
+        if column == "__key__":
+            continue
+
+        if not isinstance(value, (list, tuple)):
+            values = [value]
         else:
-            # If we got through the loop without breaking, then the entity matches
-            return True
+            # The query value can be a list of ANDed values
+            values = value
+
+        # We want this to throw if there's some op we don't know about
+        comparators = [_COMPARATORS[op](x) for x in values]
+        checks.append(_filter_check(column, comparators))
+
+    def predicate(entity):
+        if entity.kind != kind:
+            return False
+
+        for check in checks:
+            if not check(entity):
+                return False
+        return True
 
-    return False
+    return predicate
+
+
+def entity_matches_query(entity, query):
+    """
+        Return True if the entity would potentially be returned by the datastore
+        query
+    """
+    return compile_query_predicate(query)(entity)
 
 
 def ensure_datetime(value):
@@ -458,29 +540,90 @@ def ensure_datetime(value):
     return value
 
 
-def count_query(query):
+# Largest 32 bit number, fairly arbitrary but I've seen Java Cloud Datastore
+# code that uses Integer.MAX_VALUE which is this value
+MAX_COUNT = 2147483647
+
+
+def aggregation_count(query, limit=None, offset=None):
+    """
+        Counts the query with a COUNT aggregation query, only available with
+        client libraries that support them (see count_query).
+    """
+    offset = offset or 0
+    client = query._client
+
+    aggregation_query = client.aggregation_query(query).count(alias="count")
+
+    # Aggregations don't support offsets, so we count up to offset + limit
+    # and take the offset off afterwards
+    up_to = None if limit is None else offset + limit
+    count = 0
+    for results in aggregation_query.fetch(limit=up_to):
+        for result in results:
+            count = result.value
+
+    return max(0, count - offset)
+
+
+def skipped_results_count(query, limit=None, offset=None):
     """
         The Google Cloud Datastore API doesn't expose a way to count a query
         the traditional method of doing a keys-only query is apparently actually
-        slower than this method
+        slower than this method.
+
+        Setting a limit of zero and an offset will make the server (rather than
+        the client) skip the entities and then return the number of skipped
+        entities, fo realz yo! The server may stop skipping before it reaches the
+        offset, in which case we carry on from where it got to.
     """
+    offset = offset or 0
+    to_skip = MAX_COUNT if limit is None else offset + limit
+
+    from . import client_compat
+
+    # We build the protobuf ourselves, as the client's iterator won't send
+    # an offset along with a start cursor
+    query_pb = client_compat.query_to_protobuf(query)
+    query_pb.limit.value = 0
+
+    skipped = 0
+    while skipped < to_skip:
+        query_pb.offset = to_skip - skipped
+        batch = client_compat.run_query_protobuf(query, query_pb)
+        skipped += batch.skipped_results
+
+        if batch.more_results != query_pb2.QueryResultBatch.NOT_FINISHED or not batch.skipped_results:
+            break
 
-    # Largest 32 bit number, fairly arbitrary but I've seen Java Cloud Datastore
-    # code that uses Integer.MAX_VALUE which is this value
-    MAX_INT = 2147483647
+        query_pb.start_cursor = batch.end_cursor
 
-    # Setting a limit of zero and an offset of max int will make
-    # the server (rather than the client) skip the entities and then
-    # return the number of skipped entities, fo realz yo!
-    iterator = query.fetch(limit=0, offset=MAX_INT)
-    [x for x in iterator]  # Force evaluation of the iterator
+    return max(0, min(skipped, to_skip) - offset)
 
-    count = iterator._skipped_results
-    while iterator._more_results:
-        # If we have more results then use cursor offsetting and repeat
-        iterator = query.fetch(limit=0, offset=MAX_INT, start_cursor=iterator.next_page_token)
-        [x for x in iterator]  # Force evaluation of the iterator
 
-        count += iterator._skipped_results
+def get_count_strategy(query):
+    """
+        Returns the function used to count `query`. This can be overridden with
+        the GCLOUDC_COUNT_STRATEGY setting (a dotted path to a function which takes
+        the query, a limit and an offset), otherwise aggregation queries are used
+        if the client library supports them, falling back to skipping the results.
+    """
+    strategy = getattr(settings, "GCLOUDC_COUNT_STRATEGY", None)
+    if strategy:
+        return import_string(strategy)
+
+    if hasattr(query._client, "aggregation_query"):
+        return aggregation_count
+
+    return skipped_results_count
+
+
+def count_query(query, limit=None, offset=None):
+    """
+        Returns the number of results of a datastore query without fetching them.
+        Meta queries (e.g. AsyncMultiQuery) know how to count themselves.
+    """
+    if hasattr(query, "count"):
+        return query.count(limit=limit, offset=offset)
 
-    return count
+    return get_count_strategy(query)(query, limit=limit, offset=offset)
@@ -8,6 +8,12 @@ from django.db import connections
 from gcloudc.context_decorator import ContextDecorator
 from gcloudc.db.backends.datastore import transaction as datastore_transaction
 
+TransactionFailedError = datastore_transaction.TransactionFailedError
+TransactionConflictError = datastore_transaction.TransactionConflictError
+ReadOnlyTransactionError = datastore_transaction.ReadOnlyTransactionError
+transaction_metrics = datastore_transaction.transaction_metrics
+reset_transaction_metrics = datastore_transaction.reset_transaction_metrics
+
 
 class Atomic(ContextDecorator):
     # This should be the superset of any connector args (just Datastore for now)
@@ -29,6 +35,11 @@ class Atomic(ContextDecorator):
     def _do_exit(cls, state, decorator_args, exception):
         state.decorator._do_exit(state, decorator_args, exception)
 
+    def _call_decorated(self, decorator_args, args, kwargs):
+        return datastore_transaction._call_with_retries(
+            super()._call_decorated, self.func, decorator_args, args, kwargs
+        )
+
 
 atomic = Atomic
 
@@ -1,8 +1,13 @@
 from django.db import NotSupportedError
+from django.db.models import Q
 from django.test import override_settings
 
 import sleuth
 
+from gcloudc.db import transaction
+from gcloudc.db.backends.datastore import meta_queries
+from gcloudc.db.backends.datastore import transaction as datastore_transaction
+
 from . import TestCase
 from .models import MultiQueryModel
 
@@ -32,12 +37,42 @@ class AsyncMultiQueryTest(TestCase):
             list(range(100))[::-1],
         )
 
-    @override_settings(DJANGAE_MAX_QUERY_BRANCHES=10)
+    @override_settings(DJANGAE_MAX_QUERY_BRANCHES=10, GCLOUDC_MAX_QUERY_WAVES=2)
     def test_max_limit_enforced(self):
-        for i in range(11):
+        for i in range(21):
             MultiQueryModel.objects.create(field1=i)
 
-        self.assertRaises(NotSupportedError, list, MultiQueryModel.objects.filter(field1__in=list(range(11))))
+        self.assertEqual(20, len(MultiQueryModel.objects.filter(field1__in=list(range(20)))))
+        self.assertRaises(NotSupportedError, list, MultiQueryModel.objects.filter(field1__in=list(range(21))))
+
+    @override_settings(DJANGAE_MAX_QUERY_BRANCHES=3)
+    def test_branches_run_in_waves(self):
+        for i in range(10):
+            MultiQueryModel.objects.create(field1=i, field2="test")
+        MultiQueryModel.objects.create(field1=1, field2="other")
+
+        qs = MultiQueryModel.objects.filter(field1__in=list(range(10)))
+
+        self.assertCountEqual([0, 1, 1, 2, 3, 4, 5, 6, 7, 8, 9], qs.order_by().values_list("field1", flat=True))
+
+        # Ordered queries have to merge all their branches at once, so they can't run in waves
+        self.assertRaises(NotSupportedError, list, qs.order_by("-field1"))
+
+        # The offset and limit are applied across waves
+        self.assertEqual(4, len(qs.order_by()[4:8]))
+        self.assertEqual(5, len(qs.order_by()[3:8]))
+        self.assertEqual(11, qs.count())
+
+        # ...and so is the de-duplication
+        overlapping = MultiQueryModel.objects.filter(Q(field1__in=list(range(10))) | Q(field2="other"))
+        self.assertEqual(11, len(overlapping))
+        self.assertEqual(11, overlapping.count())
+
+        # Without an ordering, waves after the limit aren't run
+        with sleuth.watch("google.cloud.datastore.query.Query.fetch") as fetch:
+            self.assertEqual(2, len(qs.order_by()[:2]))
+
+        self.assertEqual(3, fetch.call_count)
 
     def test_pk_in_with_slicing(self):
         i1 = MultiQueryModel.objects.create()
@@ -63,3 +98,61 @@ class AsyncMultiQueryTest(TestCase):
 
             self.assertEqual(2, run_calls.calls[0].kwargs["limit"])
             self.assertEqual(2, run_calls.calls[1].kwargs["limit"])
+
+    def test_branches_are_merged_in_order(self):
+        for i in range(10):
+            MultiQueryModel.objects.create(field1=i, field2="even" if i % 2 == 0 else "odd")
+
+        qs = MultiQueryModel.objects.filter(field2__in=["even", "odd"])
+
+        self.assertEqual(list(qs.order_by("field1").values_list("field1", flat=True)), list(range(10)))
+
+        with sleuth.watch("gcloudc.db.backends.datastore.meta_queries.AsyncMultiQuery._sort_key") as sort_key:
+            self.assertEqual(list(qs.order_by("-field1").values_list("field1", flat=True)[1:4]), [8, 7, 6])
+
+        # Entities are only pulled from each branch as the merge reaches them
+        self.assertLessEqual(sort_key.call_count, 6)
+
+    def test_branch_pages_fetched_as_merge_reaches_them(self):
+        MultiQueryModel.objects.create(field2="test")
+        MultiQueryModel.objects.create(field2="test2")
+
+        qs = MultiQueryModel.objects.filter(field2__in=["test", "test2"])
+        fetch_page = "gcloudc.db.backends.datastore.meta_queries.AsyncMultiQuery._fetch_page"
+
+        with sleuth.watch(fetch_page) as fetch_page_calls:
+            self.assertEqual(2, len(list(qs)))
+
+        # One page each, then one more each to find there aren't any more
+        self.assertEqual(4, fetch_page_calls.call_count)
+
+        with sleuth.watch(fetch_page) as fetch_page_calls:
+            self.assertEqual(1, len(list(qs[:1])))
+
+        # Only the first page of each branch was needed
+        self.assertEqual(2, fetch_page_calls.call_count)
+
+    def test_branches_fetched_in_the_transaction(self):
+        MultiQueryModel.objects.create(field2="test")
+        MultiQueryModel.objects.create(field2="test2")
+
+        original_fetch_page = meta_queries.AsyncMultiQuery._fetch_page
+        client_transactions = []
+
+        def fetch_page(self, pages):
+            client = datastore_transaction._rpc("default")
+            client_transactions.append(client.current_transaction)
+            return original_fetch_page(self, pages)
+
+        qs = MultiQueryModel.objects.filter(field2__in=["test", "test2"])
+
+        with transaction.atomic():
+            with sleuth.switch("gcloudc.db.backends.datastore.meta_queries.AsyncMultiQuery._fetch_page", fetch_page):
+                with sleuth.watch("gcloudc.db.backends.datastore.executor.RPCExecutor.submit") as submit:
+                    self.assertEqual(2, len(qs))
+                    self.assertEqual(2, qs.count())
+
+        # The pages were fetched on this thread, as part of the transaction
+        self.assertFalse(submit.called)
+        self.assertTrue(client_transactions)
+        self.assertTrue(all(client_transactions))
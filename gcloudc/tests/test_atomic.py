@@ -2,6 +2,8 @@
 import threading
 
 import sleuth
+from google.cloud import exceptions
+
 from gcloudc.db import transaction
 
 from . import TestCase
@@ -152,6 +154,98 @@ class TransactionTests(TestCase):
         with self.assertRaises(ValueError):
             txn1("test", "banana")
 
+    def test_retries_on_conflict(self):
+        transaction.reset_transaction_metrics()
+        commit = "google.cloud.datastore.transaction.Transaction.commit"
+        calls = []
+
+        @transaction.atomic(retries=2, backoff=0.01)
+        def txn():
+            calls.append(True)
+            TestUser.objects.create(username="foo{}".format(len(calls)), field2="bar")
+
+        with sleuth.detonate(commit, exceptions.Conflict("Contention")):
+            with self.assertRaises(transaction.TransactionConflictError):
+                txn()
+
+        self.assertEqual(3, len(calls))
+        # Nothing from the failed attempts was left in the context cache
+        self.assertEqual(0, TestUser.objects.count())
+
+        original_commit = transaction.datastore_transaction.DatastoreTransaction.commit
+        conflicted = []
+
+        def conflict_once(self, *args, **kwargs):
+            if not conflicted:
+                conflicted.append(True)
+                raise exceptions.Conflict("Contention")
+            return original_commit(self, *args, **kwargs)
+
+        calls[:] = []
+        with sleuth.switch(commit, conflict_once):
+            txn()
+
+        self.assertEqual(2, len(calls))
+        self.assertEqual(["foo2"], list(TestUser.objects.values_list("username", flat=True)))
+
+        # Counted per decorated function
+        metrics = transaction.transaction_metrics()[
+            "{}.TransactionTests.test_retries_on_conflict.<locals>.txn".format(__name__)
+        ]
+        self.assertEqual(5, metrics["attempts"])
+        self.assertEqual(4, metrics["conflicts"])
+        # Only the commits which succeeded
+        self.assertEqual(1, metrics["commits"])
+
+    def test_retries_on_another_connection_inside_a_transaction(self):
+        original_commit = transaction.datastore_transaction.DatastoreTransaction.commit
+        conflicted = []
+        calls = []
+
+        def conflict_once(self, *args, **kwargs):
+            if not conflicted:
+                conflicted.append(True)
+                raise exceptions.Conflict("Contention")
+            return original_commit(self, *args, **kwargs)
+
+        @transaction.atomic(using="nonamespace", retries=1, backoff=0.01)
+        def txn():
+            calls.append(True)
+
+        with transaction.atomic():
+            with sleuth.switch("google.cloud.datastore.transaction.Transaction.commit", conflict_once):
+                # Not nested in the default connection's transaction, so it's retried
+                txn()
+
+        self.assertEqual(2, len(calls))
+
+    def test_retries_not_allowed_on_blocks(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic(retries=3):
+                pass
+
+    def test_read_only_argument(self):
+        user = TestUser.objects.create(username="foo", field2="bar")
+
+        with sleuth.watch("google.cloud.datastore.client.Client.transaction") as client_transaction:
+            with transaction.atomic(read_only=True) as txn:
+                self.assertTrue(txn.read_only)
+                self.assertEqual(user, TestUser.objects.get(pk=user.pk))
+
+                with self.assertRaises(transaction.ReadOnlyTransactionError):
+                    TestUser.objects.create(username="bar", field2="baz")
+
+                # Nested blocks are part of the read-only transaction
+                with transaction.atomic():
+                    with self.assertRaises(transaction.ReadOnlyTransactionError):
+                        user.delete()
+
+        self.assertEqual({"read_only": True}, client_transaction.calls[0].kwargs)
+        self.assertEqual(["foo"], list(TestUser.objects.values_list("username", flat=True)))
+
+        with transaction.atomic() as txn:
+            self.assertFalse(txn.read_only)
+
     def test_nested_decorator(self):
         # Nested decorator pattern we discovered can cause a connection_stack
         # underflow.
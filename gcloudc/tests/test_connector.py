@@ -2,6 +2,7 @@
 
 import datetime
 import decimal
+import itertools
 import logging
 import random
 import re
@@ -39,15 +40,17 @@ from django.utils import six
 from django.utils.safestring import SafeText
 from django.utils.six.moves import range
 from django.utils.timezone import make_aware
-from gcloudc.db.backends.datastore import transaction
-from gcloudc.db.backends.datastore.commands import FlushCommand
+from gcloudc.db.backends.datastore import dbapi, transaction
+from gcloudc.db.backends.datastore.commands import FlushCommand, UpdateCommand, bulk_create_chunks
 from gcloudc.db.backends.datastore.constraints import UNIQUE_MARKER_KIND
 from gcloudc.db.backends.datastore.indexing import (
     IExactIndexer,
     add_special_index,
     get_indexer,
 )
+from gcloudc.db.backends.datastore.meta_queries import AsyncMultiQuery
 from gcloudc.db.backends.datastore.utils import (
+    compile_query_predicate,
     count_query,
     decimal_to_string,
     entity_matches_query,
@@ -71,6 +74,7 @@ from .models import (
     ModelWithNullableCharField,
     ModelWithUniques,
     ModelWithUniquesOnForeignKey,
+    MultiQueryModel,
     MultiTableChildOne,
     MultiTableChildTwo,
     MultiTableParent,
@@ -148,6 +152,40 @@ class BackendTests(TestCase):
         entity["name"] = ["Bob", "Fred", "Dave"]
         self.assertTrue(entity_matches_query(entity, query))  # ListField test
 
+    def test_compiled_query_predicate(self):
+        rpc = transaction._rpc(default_connection.alias)
+
+        entity = Entity(rpc.key("test_model", 1))
+        entity["name"] = "Charlie"
+        entity["age"] = 22
+        entity["tags"] = ["a", "b"]
+        entity["nickname"] = None
+
+        query = rpc.query(kind="test_model")
+        query.add_filter("tags", "=", "a")
+        query.add_filter("tags", "=", "b")
+        query.add_filter("nickname", "<", "Chaz")
+        query.add_filter("__key__", ">", rpc.key("test_model", 0))
+        matches = compile_query_predicate(query)
+        self.assertTrue(matches(entity))
+
+        # Each of the ANDed values must match
+        query.add_filter("tags", "=", "c")
+        self.assertTrue(matches(entity))  # Compiled before the filter was added
+        self.assertFalse(compile_query_predicate(query)(entity))
+
+        query = rpc.query(kind="other_model")
+        self.assertFalse(compile_query_predicate(query)(entity))
+
+        # Multiqueries match if any of their queries do
+        fred = rpc.query(kind="test_model")
+        fred.add_filter("name", "=", "Fred")
+        twenty_two = rpc.query(kind="test_model")
+        twenty_two.add_filter("age", "=", 22)
+
+        self.assertTrue(entity_matches_query(entity, AsyncMultiQuery([fred, twenty_two], [])))
+        self.assertFalse(entity_matches_query(entity, AsyncMultiQuery([fred], [])))
+
     def test_exclude_pks_with_slice(self):
         for i in range(10):
             TestFruit.objects.create(name=str(i), color=str(i))
@@ -714,6 +752,224 @@ class BackendTests(TestCase):
         self.assertEqual(str, type(TestUser.objects.get().username))
         self.assertEqual(str, type(TestUser.objects.values_list("username", flat=True)[0]))
 
+    @override_settings(GCLOUDC_OPTIMISTIC_UPDATES=False)
+    def test_bulk_update_reads_entities_with_a_single_get(self):
+        for i in range(10):
+            MultiQueryModel.objects.create(field1=i)
+
+        with sleuth.watch("google.cloud.datastore.client.Client.get_multi") as get_multi:
+            updated = MultiQueryModel.objects.all().update(field2="updated")
+
+        self.assertEqual(10, updated)
+        self.assertEqual(1, get_multi.call_count)
+        self.assertEqual(10, MultiQueryModel.objects.filter(field2="updated").count())
+
+    def test_bulk_update_without_transactions(self):
+        for i in range(10):
+            MultiQueryModel.objects.create(field1=i)
+
+        with sleuth.switch("gcloudc.db.backends.datastore.transaction.TRANSACTION_ENTITY_LIMIT", 4):
+            with sleuth.watch("gcloudc.db.backends.datastore.transaction.NormalTransaction.__init__") as txn:
+                with sleuth.watch("gcloudc.db.backends.datastore.executor.RPCExecutor.submit") as submit:
+                    updated = MultiQueryModel.objects.all().update(field2="updated")
+
+        self.assertEqual(10, updated)
+        self.assertFalse(txn.called)
+        self.assertEqual(3, submit.call_count)  # The chunks are updated concurrently
+        self.assertEqual(10, MultiQueryModel.objects.filter(field2="updated").count())
+
+    def test_bulk_update_of_indexed_field_in_chunks(self):
+        for i in range(5):
+            TestFruit.objects.create(name="Fruit {}".format(i), color="Red")
+
+        # The chunks are updated on the executor's threads, and the contains index
+        # of the color needs the connection there
+        with sleuth.switch("gcloudc.db.backends.datastore.transaction.TRANSACTION_ENTITY_LIMIT", 2):
+            self.assertEqual(5, TestFruit.objects.all().update(color="Green"))
+
+        self.assertEqual(5, TestFruit.objects.filter(color__contains="ree").count())
+        self.assertEqual(0, TestFruit.objects.filter(color__contains="Re").count())
+
+    def test_bulk_update_chunks_written_before_a_failure_are_invalidated(self):
+        pks = [MultiQueryModel.objects.create(field1=i, field2="original").pk for i in range(4)]
+
+        update_entities = UpdateCommand._update_entities_optimistically
+        calls = itertools.count()
+
+        def fail_second_chunk(self, keys):
+            if next(calls) == 1:
+                raise transaction.TransactionFailedError()
+            return update_entities(self, keys)
+
+        with sleuth.switch("gcloudc.db.backends.datastore.transaction.TRANSACTION_ENTITY_LIMIT", 2):
+            with sleuth.switch(
+                "gcloudc.db.backends.datastore.commands.UpdateCommand._update_entities_optimistically",
+                fail_second_chunk
+            ):
+                with self.assertRaises(transaction.TransactionFailedError):
+                    MultiQueryModel.objects.all().update(field2="updated")
+
+        # The chunk which was written isn't still served from the cache
+        self.assertEqual(2, MultiQueryModel.objects.filter(field2="updated").count())
+        self.assertEqual(2, len([pk for pk in pks if MultiQueryModel.objects.get(pk=pk).field2 == "updated"]))
+
+    def test_bulk_update_retries_entities_changed_since_read(self):
+        instance = MultiQueryModel.objects.create(field1=1, field2="original")
+
+        from gcloudc.db.backends.datastore import client_compat
+        lookup = client_compat.lookup_with_versions
+
+        def lookup_then_change(client, keys):
+            results = lookup(client, keys)
+            if not changed:
+                # Another write sneaks in between reading the entity and writing it
+                changed.append(True)
+                MultiQueryModel.objects.filter(pk=instance.pk).update(field1=2)
+            return results
+
+        changed = []
+        with sleuth.switch("gcloudc.db.backends.datastore.client_compat.lookup_with_versions", lookup_then_change):
+            self.assertEqual(1, MultiQueryModel.objects.filter(pk=instance.pk).update(field2="updated"))
+
+        # Neither write was lost
+        instance.refresh_from_db()
+        self.assertEqual((2, "updated"), (instance.field1, instance.field2))
+
+    @override_settings(GCLOUDC_UPSERT_MODELS=["tests.TestFruit"])
+    def test_save_upserts_with_a_single_put(self):
+        fruit = TestFruit.objects.create(name="Apple", color="Red")
+        fruit.color = "Green"
+
+        with sleuth.watch("google.cloud.datastore.client.Client.get_multi") as get_multi:
+            with sleuth.watch("google.cloud.datastore.query.Query.fetch") as query_fetch:
+                with sleuth.watch("google.cloud.datastore.client.Client.put_multi") as put_multi:
+                    fruit.save()
+
+        self.assertFalse(get_multi.called)
+        self.assertFalse(query_fetch.called)
+        self.assertEqual(1, put_multi.call_count)
+        self.assertEqual("Green", TestFruit.objects.get(pk="Apple").color)
+        self.assertEqual(1, TestFruit.objects.filter(color__contains="ree").count())
+
+        # Updates of some of the fields need the rest of the entity
+        with sleuth.watch("gcloudc.db.backends.datastore.client_compat.lookup_with_versions") as lookup:
+            TestFruit.objects.filter(pk="Apple").update(color="Blue")
+
+        self.assertTrue(lookup.called)
+        self.assertEqual("Blue", TestFruit.objects.get(pk="Apple").color)
+
+        # Saving a deleted instance recreates it
+        TestFruit.objects.filter(pk="Apple").delete()
+        fruit.save()
+        self.assertEqual("Green", TestFruit.objects.get(pk="Apple").color)
+
+    def test_bulk_create_allocates_ids_with_a_single_rpc(self):
+        with sleuth.watch("google.cloud.datastore.client.Client.allocate_ids") as allocate_ids:
+            MultiQueryModel.objects.bulk_create([MultiQueryModel(field1=i) for i in range(10)])
+
+        self.assertEqual(1, allocate_ids.call_count)
+        self.assertEqual(10, MultiQueryModel.objects.count())
+
+    def test_bulk_create_checks_existing_keys_with_a_single_get(self):
+        MultiQueryModel.objects.create(pk=5)
+
+        with sleuth.watch("google.cloud.datastore.client.Client.get_multi") as get_multi:
+            MultiQueryModel.objects.bulk_create([MultiQueryModel(pk=i) for i in range(1, 5)])
+
+        self.assertEqual(1, get_multi.call_count)
+        self.assertEqual(5, MultiQueryModel.objects.count())
+
+        with self.assertRaises(IntegrityError):
+            MultiQueryModel.objects.bulk_create([MultiQueryModel(pk=i) for i in range(5, 10)])
+
+    def test_transaction_entity_limit_per_connection(self):
+        default_connection.settings_dict["TRANSACTION_ENTITY_LIMIT"] = 2
+        try:
+            self.assertEqual(2, default_connection.ops.bulk_batch_size([], []))
+
+            with sleuth.watch("google.cloud.datastore.transaction.Transaction.commit") as commit:
+                MultiQueryModel.objects.bulk_create([MultiQueryModel(field1=i) for i in range(5)])
+
+            self.assertEqual(3, commit.call_count)
+        finally:
+            del default_connection.settings_dict["TRANSACTION_ENTITY_LIMIT"]
+
+        self.assertEqual(5, MultiQueryModel.objects.count())
+        self.assertEqual(500, default_connection.ops.bulk_batch_size([], []))
+
+    def test_bulk_create_chunks(self):
+        MultiQueryModel.objects.create(pk=3)
+
+        new_connection = "gcloudc.db.backends.datastore.base.DatabaseWrapper.get_new_connection"
+        with sleuth.watch(new_connection) as get_new_connection:
+            chunks = bulk_create_chunks([MultiQueryModel(pk=i) for i in range(1, 8)], chunk_size=2, concurrency=2)
+
+        # Each worker connects once, not once per chunk
+        self.assertEqual(2, get_new_connection.call_count)
+
+        # The chunk with the existing key failed, but the rest were created
+        self.assertEqual([[1, 2], [3, 4], [5, 6], [7]], [[x.pk for x in chunk.objs] for chunk in chunks])
+        self.assertEqual([True, False, True, True], [x.succeeded for x in chunks])
+        self.assertIsInstance(chunks[1].error, IntegrityError)
+        self.assertCountEqual([1, 2, 3, 5, 6, 7], MultiQueryModel.objects.values_list("pk", flat=True))
+
+        with transaction.atomic():
+            with self.assertRaises(dbapi.NotSupportedError):
+                bulk_create_chunks([MultiQueryModel(pk=8)])
+
+    def test_iterator_streams_results(self):
+        for i in range(10):
+            MultiQueryModel.objects.create(field1=i)
+
+        transform = "gcloudc.db.backends.datastore.commands.EntityTransforms.rename_pk_field"
+        with sleuth.watch(transform) as rename_pk_field:
+            iterator = MultiQueryModel.objects.iterator(chunk_size=2)
+            next(iterator)
+
+            # Only the first chunk has been processed
+            self.assertEqual(2, rename_pk_field.call_count)
+
+            self.assertEqual(9, len(list(iterator)))
+            self.assertEqual(10, rename_pk_field.call_count)
+
+    def test_cursor_rowcount_set_once_results_are_read(self):
+        for i in range(3):
+            MultiQueryModel.objects.create(field1=i)
+
+        cursor = default_connection.cursor()
+        cursor.execute(MultiQueryModel.objects.all().query.get_compiler("default").as_sql()[0])
+
+        # Not known until the streamed results have been read
+        self.assertEqual(-1, cursor.rowcount)
+        self.assertEqual(3, len(cursor.fetchmany(10)))
+        self.assertEqual(3, cursor.rowcount)
+
+    def test_count_does_not_fetch_results(self):
+        for i in range(10):
+            MultiQueryModel.objects.create(field1=i)
+
+        with sleuth.watch("google.cloud.datastore.query.Query.fetch") as query_fetch:
+            self.assertEqual(10, MultiQueryModel.objects.count())
+            self.assertEqual(3, MultiQueryModel.objects.all()[2:5].count())
+            self.assertEqual(2, MultiQueryModel.objects.all()[8:].count())
+            self.assertEqual(0, MultiQueryModel.objects.all()[12:].count())
+
+        self.assertFalse(query_fetch.called)
+
+        # Branches of a multi query, and keys which don't exist, are only counted once
+        self.assertEqual(2, MultiQueryModel.objects.filter(Q(field1__in=[1, 2, 11]) | Q(field1=2)).count())
+        pks = list(MultiQueryModel.objects.values_list("pk", flat=True)[:3])
+        self.assertEqual(3, MultiQueryModel.objects.filter(pk__in=pks + [99999]).count())
+
+    @override_settings(GCLOUDC_COUNT_STRATEGY="gcloudc.db.backends.datastore.utils.skipped_results_count")
+    def test_count_strategy_setting(self):
+        MultiQueryModel.objects.create(field1=1)
+
+        with sleuth.watch("gcloudc.db.backends.datastore.utils.skipped_results_count") as strategy:
+            self.assertEqual(1, MultiQueryModel.objects.count())
+
+        self.assertTrue(strategy.called)
+
 
 class ModelFormsetTest(TestCase):
     def test_reproduce_index_error(self):
@@ -1413,10 +1669,10 @@ class EdgeCaseTests(TestCase):
             list(dates)
         )
 
-    @override_settings(DJANGAE_MAX_QUERY_BRANCHES=30)
+    @override_settings(DJANGAE_MAX_QUERY_BRANCHES=30, GCLOUDC_MAX_QUERY_WAVES=1)
     def test_in_query(self):
-        """ Test that the __in filter works, and that it cannot be used with more than 30 values,
-            unless it's used on the PK field.
+        """ Test that the __in filter works, and that it cannot be used with more than 30 values
+            (in a single wave), unless it's used on the PK field.
         """
         # Check that a basic __in query works
         results = list(TestUser.objects.filter(username__in=['A', 'B']))
@@ -0,0 +1,367 @@
+import sys
+import time
+
+import sleuth
+from django.db import connection as default_connection
+from django.test import override_settings
+from google.cloud.datastore.entity import Entity
+from google.cloud.datastore.key import Key
+
+from gcloudc.db import transaction
+from gcloudc.db.backends.datastore import caching
+from gcloudc.db.backends.datastore import transaction as datastore_transaction
+from gcloudc.db.backends.datastore.context import CacheDict, ExpiringCacheDict, SerializedEntity
+
+from . import TestCase
+from .models import TestFruit, TestUser
+
+
+class CacheDictTest(TestCase):
+
+    def test_values_shared_between_keys(self):
+        cache_dict = CacheDict(debug_checks=True)
+        cache_dict.set_multi(["a", "b"], {"value": 1})
+
+        self.assertEqual({"value": 1}, cache_dict["a"])
+        self.assertEqual({"value": 1}, cache_dict["b"])
+        self.assertEqual(1, len(cache_dict.value_priority))
+
+        del cache_dict["a"]
+        self.assertNotIn("a", cache_dict)
+        self.assertIn("b", cache_dict)
+        self.assertEqual(1, len(cache_dict.value_priority))
+
+        del cache_dict["b"]
+        self.assertEqual(0, len(cache_dict.value_priority))
+        self.assertEqual(0, cache_dict.total_value_size)
+
+    def test_least_recently_used_evicted_first(self):
+        value_size = sys.getsizeof({"value": 1})
+        cache_dict = CacheDict(max_size_in_bytes=value_size * 2, debug_checks=True)
+
+        cache_dict.set_multi(["a", "a2"], {"value": 1})
+        cache_dict.set_multi(["b"], {"value": 2})
+
+        # Access a, so b becomes the least recently used
+        cache_dict["a2"]
+
+        cache_dict.set_multi(["c"], {"value": 3})
+
+        self.assertIn("a", cache_dict)
+        self.assertIn("a2", cache_dict)
+        self.assertNotIn("b", cache_dict)
+        self.assertIn("c", cache_dict)
+
+        # Now a is the least recently used, all of its keys go together
+        cache_dict.set_multi(["d"], {"value": 4})
+
+        self.assertNotIn("a", cache_dict)
+        self.assertNotIn("a2", cache_dict)
+        self.assertIn("c", cache_dict)
+        self.assertIn("d", cache_dict)
+        self.assertEqual(value_size * 2, cache_dict.total_value_size)
+
+    def test_values_are_copied(self):
+        cache_dict = CacheDict()
+        value = {"value": 1}
+        cache_dict.set_multi(["a"], value)
+
+        value["value"] = 2
+        self.assertEqual({"value": 1}, cache_dict["a"])
+
+        cache_dict["a"]["value"] = 3
+        self.assertEqual({"value": 1}, cache_dict["a"])
+
+    def test_keys_for_entity_key(self):
+        cache_dict = CacheDict(debug_checks=True)
+
+        key = Key("TestKind", 1, project="test")
+        entity = Entity(key)
+        entity["value"] = 1
+
+        cache_dict.set_multi(["a", "b"], entity)
+        cache_dict.set_multi(["c"], {"value": 1})
+
+        self.assertCountEqual(["a", "b"], cache_dict.keys_for_entity_key(key))
+        self.assertEqual([], cache_dict.keys_for_entity_key(Key("TestKind", 2, project="test")))
+
+        # Replacing the value of a key moves it off the entity's references
+        cache_dict.set_multi(["b"], {"value": 2})
+        self.assertEqual(["a"], cache_dict.keys_for_entity_key(key))
+
+        del cache_dict["a"]
+        self.assertEqual([], cache_dict.keys_for_entity_key(key))
+        self.assertEqual({}, cache_dict.key_references)
+
+    def test_serialized_entities(self):
+        cache_dict = CacheDict(debug_checks=True, serialize_entities=True)
+
+        key = Key("TestKind", 1, project="test")
+        entity = Entity(key)
+        entity["value"] = 1
+
+        cache_dict.set_multi(["a", "b"], entity)
+
+        stored = cache_dict._entries["a"]
+        self.assertIsInstance(stored, SerializedEntity)
+        self.assertEqual(len(stored.data), cache_dict.total_value_size)
+        self.assertEqual(["a", "b"], sorted(cache_dict.keys_for_entity_key(key)))
+
+        cached = cache_dict["a"]
+        self.assertEqual(entity, cached)
+        self.assertEqual(key, cached.key)
+
+        # Each read gets its own entity
+        cached["value"] = 2
+        self.assertEqual(1, cache_dict["b"]["value"])
+
+        # Non-entities are still copied
+        cache_dict.set_multi(["c"], {"value": 1})
+        self.assertEqual({"value": 1}, cache_dict["c"])
+
+
+class ExpiringCacheDictTest(TestCase):
+
+    def test_expired_values_are_removed(self):
+        cache_dict = ExpiringCacheDict(60, debug_checks=True)
+        cache_dict.set_multi(["a", "b"], {"value": 1})
+        self.assertEqual({"value": 1}, cache_dict["a"])
+
+        with sleuth.switch("time.monotonic", lambda: time.time() + 120):
+            self.assertIsNone(cache_dict.get("a"))
+
+        # All the keys of the expired value go together
+        self.assertNotIn("b", cache_dict)
+        self.assertEqual(0, cache_dict.total_value_size)
+
+
+class ContextCacheTest(TestCase):
+
+    def test_multi_key_fetch_uses_cached_entities(self):
+        users = [
+            TestUser.objects.create(username=str(i), first_name=str(i), second_name="b")
+            for i in range(3)
+        ]
+
+        caching.reset_context()
+        TestUser.objects.get(pk=users[1].pk)  # Cache it
+
+        with sleuth.watch("google.cloud.datastore.client.Client.get_multi") as get_multi:
+            results = list(TestUser.objects.filter(pk__in=[x.pk for x in users]).order_by("pk"))
+
+        self.assertEqual(users, results)
+
+        # Only the entities which weren't cached were fetched
+        self.assertEqual(1, get_multi.call_count)
+        fetched = get_multi.calls[0].args[1]
+        self.assertCountEqual([users[0].pk, users[2].pk], [x.id_or_name for x in fetched])
+
+        # ...and now they're cached too
+        with sleuth.watch("google.cloud.datastore.client.Client.get_multi") as get_multi:
+            self.assertEqual(3, len(TestUser.objects.filter(pk__in=[x.pk for x in users])))
+
+        self.assertFalse(get_multi.called)
+
+
+@override_settings(GCLOUDC_SHARED_CACHE_MODELS=["tests.TestUser"])
+class SharedCacheTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        caching.clear_shared_cache()
+
+    def tearDown(self):
+        caching.clear_shared_cache()
+        super().tearDown()
+
+    def test_entities_shared_between_requests(self):
+        user = TestUser.objects.create(username="test", first_name="a", second_name="b")
+        caching.reset_context()
+        TestUser.objects.get(pk=user.pk)  # Cache it
+
+        caching.reset_context()
+
+        with sleuth.watch("google.cloud.datastore.client.Client.get") as datastore_get:
+            self.assertEqual("test", TestUser.objects.get(pk=user.pk).username)
+
+        self.assertFalse(datastore_get.called)
+
+    def test_writes_invalidate(self):
+        user = TestUser.objects.create(username="test", first_name="a", second_name="b")
+        caching.reset_context()
+        TestUser.objects.get(pk=user.pk)
+
+        TestUser.objects.filter(pk=user.pk).update(username="updated")
+        caching.reset_context()
+        self.assertEqual("updated", TestUser.objects.get(pk=user.pk).username)
+
+        user.delete()
+        caching.reset_context()
+        self.assertFalse(TestUser.objects.filter(pk=user.pk).exists())
+
+    def test_entities_written_while_being_read_not_cached(self):
+        user = TestUser.objects.create(username="test", first_name="a", second_name="b")
+        caching.reset_context()
+
+        get = datastore_transaction.Transaction.get
+
+        def get_then_write(rpc, *args, **kwargs):
+            result = get(rpc, *args, **kwargs)
+            if not written:
+                # Another thread writes the entity after we've read it
+                written.append(True)
+                TestUser.objects.filter(pk=user.pk).update(username="updated")
+            return result
+
+        written = []
+        with sleuth.switch("gcloudc.db.backends.datastore.transaction.Transaction.get", get_then_write):
+            self.assertEqual("test", TestUser.objects.get(pk=user.pk).username)
+
+        # The stale entity wasn't put back after the write invalidated it
+        caching.reset_context()
+        self.assertEqual("updated", TestUser.objects.get(pk=user.pk).username)
+
+    def test_bypassed_in_transactions(self):
+        user = TestUser.objects.create(username="test", first_name="a", second_name="b")
+        caching.reset_context()
+        TestUser.objects.get(pk=user.pk)
+
+        caching.reset_context()
+
+        with transaction.atomic():
+            with sleuth.watch("google.cloud.datastore.client.Client.get") as datastore_get:
+                TestUser.objects.get(pk=user.pk)
+
+            self.assertTrue(datastore_get.called)
+
+    def test_used_in_transactions_on_other_connections(self):
+        user = TestUser.objects.create(username="test", first_name="a", second_name="b")
+        caching.reset_context()
+        TestUser.objects.get(pk=user.pk)
+
+        caching.reset_context()
+
+        with transaction.atomic(using="nonamespace"):
+            with sleuth.watch("google.cloud.datastore.client.Client.get") as datastore_get:
+                TestUser.objects.get(pk=user.pk)
+
+            self.assertFalse(datastore_get.called)
+
+    def test_other_models_not_shared(self):
+        fruit = TestFruit.objects.create(name="apple", color="red")
+        caching.reset_context()
+        TestFruit.objects.get(pk=fruit.pk)
+
+        caching.reset_context()
+
+        with sleuth.watch("google.cloud.datastore.client.Client.get") as datastore_get:
+            TestFruit.objects.get(pk=fruit.pk)
+
+        self.assertTrue(datastore_get.called)
+        self.assertIsNone(caching.shared_cache_generation(TestFruit))
+
+
+@override_settings(
+    GCLOUDC_SHARED_CACHE_MODELS=["tests.TestUser"],
+    GCLOUDC_CACHE_BACKEND="gcloudc.db.backends.datastore.cache_backends.LocalCacheBackend",
+)
+class CacheBackendTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        caching.clear_shared_cache()
+        caching.get_cache_backend().clear()
+
+    def tearDown(self):
+        caching.clear_shared_cache()
+        caching.get_cache_backend().clear()
+        super().tearDown()
+
+    def _username_identifier(self, username):
+        return "{}|username:{}".format(TestUser._meta.db_table, username)
+
+    def _new_instance(self):
+        # Another instance has its own context and process-wide caches, only
+        # the external cache is shared
+        caching.reset_context()
+        caching.clear_shared_cache()
+
+    def test_entities_shared_between_instances(self):
+        user = TestUser.objects.create(username="test", first_name="a", second_name="b")
+        self._new_instance()
+        TestUser.objects.get(pk=user.pk)  # Cache it
+
+        self._new_instance()
+
+        with sleuth.watch("gcloudc.db.backends.datastore.cache_backends.LocalCacheBackend.get_multi") as get_multi:
+            with sleuth.watch("google.cloud.datastore.client.Client.get") as datastore_get:
+                self.assertEqual("test", TestUser.objects.get(pk=user.pk).username)
+
+        self.assertTrue(get_multi.called)
+        self.assertFalse(datastore_get.called)
+
+        # Unique lookups are served from the external cache too
+        self._new_instance()
+        namespace = default_connection.settings_dict.get("NAMESPACE")
+        identifier = self._username_identifier("test")
+        self.assertEqual(user.pk, caching.get_from_cache(identifier, namespace).key.id_or_name)
+
+    def test_writes_invalidate(self):
+        user = TestUser.objects.create(username="test", first_name="a", second_name="b")
+        self._new_instance()
+        TestUser.objects.get(pk=user.pk)
+
+        rpc = datastore_transaction._rpc(default_connection.alias)
+        backend_key = caching._backend_key_for_datastore_key(rpc.key(TestUser._meta.db_table, user.pk))
+
+        with transaction.atomic():
+            TestUser.objects.filter(pk=user.pk).update(username="updated")
+
+            # Not invalidated until the transaction commits
+            self.assertTrue(caching.get_cache_backend().get_multi([backend_key]))
+
+        self.assertFalse(caching.get_cache_backend().get_multi([backend_key]))
+
+        self._new_instance()
+        self.assertEqual("updated", TestUser.objects.get(pk=user.pk).username)
+
+        namespace = default_connection.settings_dict.get("NAMESPACE")
+        self.assertIsNone(caching.get_from_cache(self._username_identifier("test"), namespace))
+
+    def test_entities_written_while_being_read_not_cached(self):
+        user = TestUser.objects.create(username="test", first_name="a", second_name="b")
+        self._new_instance()
+
+        get = datastore_transaction.Transaction.get
+
+        def get_then_write(rpc, *args, **kwargs):
+            result = get(rpc, *args, **kwargs)
+            if not written:
+                written.append(True)
+                TestUser.objects.filter(pk=user.pk).update(username="updated")
+            return result
+
+        written = []
+        with sleuth.watch("gcloudc.db.backends.datastore.cache_backends.LocalCacheBackend.set_multi") as set_multi:
+            with sleuth.switch("gcloudc.db.backends.datastore.transaction.Transaction.get", get_then_write):
+                TestUser.objects.get(pk=user.pk)
+
+        self.assertFalse(set_multi.called)
+
+        self._new_instance()
+        self.assertEqual("updated", TestUser.objects.get(pk=user.pk).username)
+
+        # Entities expire after the (short) backend timeout, not the process-wide one
+        with sleuth.watch("gcloudc.db.backends.datastore.cache_backends.LocalCacheBackend.set_multi") as set_multi:
+            self._new_instance()
+            TestUser.objects.get(pk=user.pk)
+
+        self.assertEqual(caching.DEFAULT_CACHE_BACKEND_TIMEOUT, set_multi.calls[0].args[2])
+
+    def test_memcache_disabled(self):
+        user = TestUser.objects.create(username="test", first_name="a", second_name="b")
+        self._new_instance()
+        caching.get_context().memcache_enabled = False
+
+        TestUser.objects.get(pk=user.pk)
+        self.assertFalse(caching.get_cache_backend()._values)
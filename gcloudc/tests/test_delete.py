@@ -1,3 +1,9 @@
+import sleuth
+from django.test import override_settings
+
+from gcloudc.db import transaction
+from gcloudc.db.backends.datastore.commands import BulkDeleteError
+
 from . import TestCase
 from .models import TestUser
 
@@ -33,3 +39,36 @@ class DeleteTestCase(TestCase):
 
         TestUser.objects.all().delete()
         self.assertEqual(TestUser.objects.count(), 0)
+
+    def test_bulk_delete_beyond_transaction_limit(self):
+        for i in range(5):
+            TestUser.objects.create(username=str(i), first_name=str(i), second_name="B")
+
+        limit = "gcloudc.db.backends.datastore.transaction.TRANSACTION_ENTITY_LIMIT"
+        with sleuth.switch(limit, 2):
+            with sleuth.watch("google.cloud.datastore.transaction.Transaction.commit") as commit:
+                TestUser.objects.all().delete()
+
+        self.assertEqual(3, commit.call_count)
+        self.assertEqual(TestUser.objects.count(), 0)
+
+    @override_settings(GCLOUDC_BULK_DELETE_CONCURRENCY=2)
+    def test_concurrent_bulk_delete(self):
+        for i in range(5):
+            TestUser.objects.create(username=str(i), first_name=str(i), second_name="B")
+
+        with sleuth.switch("gcloudc.db.backends.datastore.transaction.TRANSACTION_ENTITY_LIMIT", 2):
+            TestUser.objects.filter(second_name="B").delete()
+
+        self.assertEqual(TestUser.objects.count(), 0)
+
+    def test_bulk_delete_beyond_transaction_limit_in_atomic_block(self):
+        for i in range(3):
+            TestUser.objects.create(username=str(i), first_name=str(i), second_name="B")
+
+        with sleuth.switch("gcloudc.db.backends.datastore.transaction.TRANSACTION_ENTITY_LIMIT", 2):
+            with self.assertRaises(BulkDeleteError):
+                with transaction.atomic():
+                    TestUser.objects.all().delete()
+
+        self.assertEqual(TestUser.objects.count(), 3)
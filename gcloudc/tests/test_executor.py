@@ -0,0 +1,56 @@
+import threading
+
+import sleuth
+
+from gcloudc.db.backends.datastore.executor import RPCExecutor, executor_metrics
+
+from . import TestCase
+from .models import MultiQueryModel
+
+
+class RPCExecutorTest(TestCase):
+
+    def test_submit_blocks_when_queue_is_full(self):
+        executor = RPCExecutor(thread_count=1, queue_size=1)
+        release = threading.Event()
+
+        try:
+            running = executor.submit(release.wait)
+            queued = executor.submit(lambda: None)
+
+            submitted = threading.Event()
+
+            def submit():
+                executor.submit(lambda: None)
+                submitted.set()
+
+            thread = threading.Thread(target=submit)
+            thread.start()
+
+            # The thread is busy and the queue is full, so the submit has to wait
+            self.assertFalse(submitted.wait(0.1))
+            self.assertEqual(1, executor.metrics()["in_flight"])
+            self.assertEqual(1, executor.metrics()["queue_depth"])
+
+            release.set()
+            thread.join()
+
+            self.assertTrue(running.result())
+            self.assertIsNone(queued.result())
+            self.assertTrue(submitted.is_set())
+        finally:
+            release.set()
+            executor.shutdown()
+
+    def test_multi_queries_use_shared_executor(self):
+        MultiQueryModel.objects.create(field2="test")
+        MultiQueryModel.objects.create(field2="test2")
+
+        with sleuth.watch("gcloudc.db.backends.datastore.executor.RPCExecutor.submit") as submit:
+            self.assertEqual(2, len(MultiQueryModel.objects.filter(field2__in=["test", "test2"])))
+
+        self.assertTrue(submit.called)
+
+        metrics = executor_metrics()
+        self.assertEqual(0, metrics["queue_depth"])
+        self.assertEqual(0, metrics["in_flight"])
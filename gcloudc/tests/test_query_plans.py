@@ -0,0 +1,110 @@
+import sleuth
+from django.db.models import Q
+from django.test import override_settings
+
+from gcloudc.db import transaction
+from gcloudc.db.backends.datastore import caching, query_plans
+
+from . import TestCase
+from .models import TestUser
+
+
+class QueryPlanCacheTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        query_plans.clear_query_plan_cache()
+
+        TestUser.objects.create(username="a", first_name="a", second_name="a", email="a@example.com")
+        TestUser.objects.create(username="b", first_name="b", second_name="b", email="b@example.com")
+        TestUser.objects.create(username="c", first_name="c", second_name="c", email="a@example.com")
+
+    def test_plans_reused_for_queries_of_the_same_shape(self):
+        def query(username, email):
+            return TestUser.objects.filter(
+                Q(username=username) | Q(first_name="c"), email=email
+            ).values_list("username", flat=True)
+
+        self.assertCountEqual(["a", "c"], query("a", "a@example.com"))
+
+        with sleuth.watch("gcloudc.db.backends.datastore.query_plans.normalize_query") as normalize_query:
+            self.assertCountEqual(["b"], query("b", "b@example.com"))
+            self.assertCountEqual([], query("c", "b@example.com"))
+
+        self.assertFalse(normalize_query.called)
+
+    def test_duplicate_values_are_removed(self):
+        users = TestUser.objects.filter(username__in=["a", "c", "d"])
+
+        with sleuth.watch("gcloudc.db.backends.datastore.meta_queries.AsyncMultiQuery.__init__") as multi_query:
+            self.assertEqual(2, users.count())
+            self.assertEqual(1, TestUser.objects.filter(username__in=["a", "a", "a"]).count())
+
+        # The second query was a single query, rather than three identical ones
+        self.assertEqual(1, multi_query.call_count)
+
+    def test_value_dependent_queries_are_not_cached(self):
+        self.assertEqual(1, TestUser.objects.filter(username="a").filter(username="a").count())
+        self.assertEqual(0, TestUser.objects.filter(username="a").filter(username="b").count())
+
+        with sleuth.watch("gcloudc.db.backends.datastore.query_plans.normalize_query") as normalize_query:
+            self.assertEqual(0, TestUser.objects.filter(username="a").filter(username="c").count())
+
+        self.assertTrue(normalize_query.called)
+
+    @override_settings(GCLOUDC_QUERY_PLAN_CACHE_SIZE=0)
+    def test_cache_can_be_disabled(self):
+        self.assertEqual(1, TestUser.objects.filter(username="a").count())
+
+        with sleuth.watch("gcloudc.db.backends.datastore.query_plans.normalize_query") as normalize_query:
+            self.assertEqual(1, TestUser.objects.filter(username="b").count())
+
+        self.assertTrue(normalize_query.called)
+        self.assertFalse(query_plans._plans)
+
+
+class KeyLookupTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.users = [
+            TestUser.objects.create(username=str(i), first_name="even" if i % 2 == 0 else "odd", second_name=str(i))
+            for i in range(6)
+        ]
+
+    def test_key_lists_not_exploded(self):
+        pks = [self.users[i].pk for i in (4, 0, 3, 2, 0)]
+
+        with sleuth.watch("gcloudc.db.backends.datastore.query_plans.normalize_query") as normalize_query:
+            results = list(TestUser.objects.filter(pk__in=pks, first_name="even"))
+
+        self.assertFalse(normalize_query.called)
+
+        # The other filters are applied in memory, in the order the keys were asked for
+        self.assertEqual([self.users[4], self.users[0], self.users[2]], results)
+
+        self.assertEqual(3, TestUser.objects.filter(pk__in=pks, first_name="even").count())
+        self.assertEqual([self.users[0]], list(TestUser.objects.filter(pk__in=pks).filter(pk__in=[self.users[0].pk])))
+        self.assertEqual(
+            [self.users[4], self.users[3]], list(TestUser.objects.filter(pk__in=pks).order_by("-username")[:2])
+        )
+
+    def test_keys_fetched_in_concurrent_batches(self):
+        pks = [x.pk for x in self.users]
+
+        # Make sure the entities aren't just read from the context cache
+        caching.reset_context()
+
+        with sleuth.switch("gcloudc.db.backends.datastore.meta_queries.MAX_KEYS_PER_GET", 4):
+            with sleuth.watch("gcloudc.db.backends.datastore.executor.RPCExecutor.submit") as submit:
+                self.assertEqual(self.users, list(TestUser.objects.filter(pk__in=pks)))
+
+            self.assertEqual(2, submit.call_count)
+
+            # Transactions are tied to the thread, so the batches are sent one by one
+            caching.reset_context()
+            with transaction.atomic():
+                with sleuth.watch("gcloudc.db.backends.datastore.executor.RPCExecutor.submit") as submit:
+                    self.assertEqual(self.users, list(TestUser.objects.filter(pk__in=pks)))
+
+            self.assertFalse(submit.called)
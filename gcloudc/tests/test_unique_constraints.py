@@ -82,6 +82,34 @@ class TestUniqueConstraints(TestCase):
             TestUserTwo.objects.bulk_create([TestUserTwo(username="Mickey Bell"), TestUserTwo(username="Tony Thorpe")])
         self.assertEqual(TestUserTwo.objects.count(), 2)
 
+    def test_bulk_insert_shares_unique_lookups(self):
+        """
+        Assert that entities of a bulk insert which need the same unique
+        lookup only cause it to be run once.
+        """
+        with sleuth.watch("google.cloud.datastore.query.Query.fetch") as query_fetch:
+            with self.assertRaises(IntegrityError):
+                TestUserTwo.objects.bulk_create(
+                    [
+                        TestUserTwo(username="Mickey Bell"),
+                        TestUserTwo(username="Mickey Bell"),
+                        TestUserTwo(username="Tony Thorpe"),
+                    ]
+                )
+
+        self.assertEqual(query_fetch.call_count, 2)
+
+    def test_unique_lookups_run_in_the_transaction(self):
+        """
+        The unique lookups of an insert are run on this thread, otherwise they
+        wouldn't be part of the insert's transaction.
+        """
+        with sleuth.watch("gcloudc.db.backends.datastore.executor.RPCExecutor.submit") as submit:
+            TestUserTwo.objects.bulk_create([TestUserTwo(username="Mickey Bell"), TestUserTwo(username="Tony Thorpe")])
+
+        self.assertFalse(submit.called)
+        self.assertEqual(2, TestUserTwo.objects.count())
+
     def test_update_with_constraint_conflict(self):
         TestUserTwo.objects.create(username="AshtonGateEight")
         user_two = TestUserTwo.objects.create(username="AshtonGateSeven")
@@ -100,6 +128,20 @@ class TestUniqueConstraints(TestCase):
         with self.assertRaises(IntegrityError):
             user_two.save()
 
+    @override_settings(GCLOUDC_UPSERT_ON_SAVE=True)
+    def test_upsert_with_constraint_conflict(self):
+        TestUserTwo.objects.create(username="AshtonGateEight")
+        user_two = TestUserTwo.objects.create(username="AshtonGateSeven")
+
+        user_two.username = "AshtonGateEight"
+        with sleuth.watch("gcloudc.db.backends.datastore.commands.perform_unique_checks") as unique_checks:
+            with self.assertRaises(IntegrityError):
+                user_two.save()
+
+        self.assertTrue(unique_checks.called)
+        user_two.refresh_from_db()
+        self.assertEqual("AshtonGateSeven", user_two.username)
+
     def test_error_on_update_does_not_change_entity(self):
         """
         Assert that when there is an error / exception raised as part of the
@@ -214,22 +256,21 @@ class TestUniqueConstraints(TestCase):
                 second_name=second_name,
             )
 
-        # This should raise because of the 500 changes per transaction limit
-        with self.assertRaises(IntegrityError):
-            TestUser.objects.all().update(first_name="lee")
+        # Updates are split into transactions of up to 500 entities
+        self.assertEqual(501, TestUser.objects.all().update(first_name="lee"))
 
-    def test_bulk_delete_fails_if_limit_exceeded(self):
+    def test_bulk_delete_split_if_limit_exceeded(self):
         """
-        Assert that there is currently a practical limitation when deleting multi
-        entities, based on a combination of the unique markers per model
-        and transaction limit of touching 500 entities.
+        Assert that deleting more entities than fit in a single transaction
+        deletes them in several transactions.
         """
         TestUserTwo.objects.create(username="Mickey Bell")
         TestUserTwo.objects.create(username="Tony Thorpe")
 
         with sleuth.switch("gcloudc.db.backends.datastore.transaction.TRANSACTION_ENTITY_LIMIT", 1):
-            with self.assertRaises(Exception):
-                TestUserTwo.objects.all().delete()
+            TestUserTwo.objects.all().delete()
+
+        self.assertEqual(TestUserTwo.objects.count(), 0)
 
     def test_delete_entity_fails(self):
         """